@@ -1,78 +1,247 @@
-print("🔥 Running backend version: 2025-11-24 16:00")
 import os
+import logging
+import re
 import json
+import time
+import uuid
 import asyncio
-from typing import Optional, List
+import orjson
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request, Body
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from sqlalchemy import select, desc
+from sqlalchemy import select, desc, literal, update, delete, func
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from dotenv import load_dotenv
 from google.cloud import storage
 
-from db import SessionLocal, init_db, User, Message, Room, RoomMember, Inventory, GroceryItem, ShoppingList
-from auth import get_password_hash, verify_password, create_access_token, get_current_user_token
-from websocket_manager import ConnectionManager
-from llm import chat_completion, AVAILABLE_MODELS
+from db import SessionLocal, engine, init_db, get_db, User, Message, Room, RoomMember, Inventory, GroceryItem, ShoppingList
+from auth import get_password_hash, verify_password, create_access_token, decode_access_token, get_current_user
+from websocket_manager import ConnectionManager, WS_FORMATS
+from llm import chat_completion_stream, close_http_client, close_completion_cache, AVAILABLE_MODELS, GEMINI_AVAILABLE, reply_cache_key, get_cached_reply, set_cached_reply
 
 # LLM modules
-from llm_modules.llm_utils import format_chat_history
+from llm_modules.llm_utils import format_chat_history, trim_history_to_token_budget
 from llm_modules.planner import generate_group_plan
 from llm_modules.matcher import suggest_invites
 from llm_modules.inventory_analyzer import analyze_inventory
 from llm_modules.menu_generator import generate_menu
 from llm_modules.procurement_planner import generate_restock_plan
 from llm_modules.chat_procurement_planner import generate_procurement_plan
-from vector.recommend_utils import get_relevant_grocery_items
+from vector.recommend_utils import get_relevant_grocery_items_bulk
+from vector.vector_cache import NPY_MATRIX_FILE, NPY_IDS_FILE, CLOUD_NPY_DIR, EMBEDDINGS_DIR
 
 load_dotenv()
 
+# Diagnostics go through logging so per-request DEBUG lines cost nothing at the default INFO level
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+logging.getLogger("grocery").setLevel(LOG_LEVEL)
+logger = logging.getLogger("grocery.api")
+logger.info("Running backend version: 2025-11-24 16:00")
+
 APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
 APP_PORT = int(os.getenv("APP_PORT", "8000"))
 GROCERY_CSV_PATH = os.getenv("GROCERY_CSV_PATH", "./GroceryDataset.csv")
+# Set to fan WebSocket broadcasts out through Redis pub/sub (required for more than one worker)
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+# Model names and their availability are fixed for the life of the process
+LLM_MODEL_NAMES = list(AVAILABLE_MODELS.keys())
+VALID_LLM_MODELS = frozenset(LLM_MODEL_NAMES)
+# Comma-separated list of browser origins allowed to call the API (local dev ports are always allowed).
+# Defaults to the Firebase Hosting origins the production Flutter web build is served from.
+DEFAULT_CORS_ALLOW_ORIGINS = ",".join([
+    "https://groceryshopperai.web.app",
+    "https://groceryshopperai.firebaseapp.com",
+    "https://groceryshopperai-78a1b.web.app",
+    "https://groceryshopperai-78a1b.firebaseapp.com",
+])
+CORS_ALLOW_ORIGINS = [o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", DEFAULT_CORS_ALLOW_ORIGINS).split(",") if o.strip()]
+CORS_LOCALHOST_REGEX = r"https?://(localhost|127\.0\.0\.1)(:\d+)?"
+
+# WebSocket heartbeat: ping quiet sockets, evict ones that stop answering
+WS_PING_INTERVAL_SECONDS = 30
+WS_PONG_TIMEOUT_SECONDS = 10
+WS_SWEEP_INTERVAL_SECONDS = 60
+
+# Bounded LLM work queue: @gro replies run on a fixed pool of workers instead of one task per message
+LLM_QUEUE_MAXSIZE = int(os.getenv("LLM_QUEUE_MAXSIZE", "1000"))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "4"))
+llm_queue: asyncio.Queue = asyncio.Queue(maxsize=LLM_QUEUE_MAXSIZE)
+
+# Messages of room history handed to the AI modules per command
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "50"))
+# ...further trimmed (oldest first) so the history part of a prompt stays under this many tokens
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4096"))
+CHAT_HISTORY_CACHE_MAX_ROOMS = 1000
+# room_id -> (max message id, message count, limit, [(message id, turn)] oldest first)
+_chat_history_cache: Dict[int, Tuple[int, int, int, List[Tuple[int, dict]]]] = {}
+# Incremental refreshes re-read this many ids below the cached max: auto-increment ids can commit out of order
+CHAT_HISTORY_OVERLAP_IDS = 100
+
+# AI plan/matching calls currently running, by (kind, room, model, goal, context hash):
+# concurrent identical requests share one LLM call instead of each starting their own
+_inflight_ai: Dict[tuple, asyncio.Future] = {}
+
+# Catalog matches fetched per inventory item for @gro commands, and the cap on how many go into one prompt
+GROCERY_MATCHES_PER_ITEM = 5
+GROCERY_PROMPT_MAX_ITEMS = int(os.getenv("GROCERY_PROMPT_MAX_ITEMS", "40"))
+
 CSV_HEADERS = ["Sub Category", " Price ", "Rating", "Title"]
 
 # ========= Embeddings Initialization (Cloud Run + GCS Auto Download) =========
 LOCAL_EMBEDDINGS_PATH = "/tmp/embeddings.sqlite"
 EMBEDDINGS_BUCKET = "groceryshopperai-embeddings"
 EMBEDDINGS_BLOB = "embeddings.sqlite"
+# Packed form (embedding_loader.pack_embeddings), memory-mapped by vector_cache; preferred when in the bucket
+EMBEDDINGS_NPY_BLOBS = (NPY_MATRIX_FILE, NPY_IDS_FILE)
+
+def download_blob_if_needed(bucket, blob_name: str, local_path: str) -> bool:
+    """
+    Download gs://bucket/blob_name to local_path unless a complete copy is already there.
+    Returns whether local_path holds the blob afterwards.
+    """
+    try:
+        blob = bucket.get_blob(blob_name)
+    except Exception as e:
+        blob = None
+        logger.warning("Could not read metadata of %s: %s", blob_name, e)
+
+    if os.path.exists(local_path):
+        # A file from an earlier (possibly interrupted) run is only trusted if the size matches
+        if blob is None or blob.size is None or os.path.getsize(local_path) == blob.size:
+            logger.info("Found existing %s", local_path)
+            return True
+        logger.info("Existing %s is incomplete, downloading again", local_path)
+
+    if blob is None:
+        logger.info("gs://%s/%s not available", EMBEDDINGS_BUCKET, blob_name)
+        return False
+
+    logger.info("Downloading %s from bucket %s...", blob_name, EMBEDDINGS_BUCKET)
+    partial_path = local_path + ".part"
+    try:
+        # Download next to the target and rename, so readers never see a half-written file
+        blob.download_to_filename(partial_path)
+        if blob.size is not None and os.path.getsize(partial_path) != blob.size:
+            raise IOError(f"size mismatch ({os.path.getsize(partial_path)} != {blob.size} bytes)")
+        os.replace(partial_path, local_path)
+        logger.info("Download complete: %s", local_path)
+        return True
+    except Exception as e:
+        logger.error("Failed to download %s: %s", blob_name, e)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return False
 
 def download_embeddings_if_needed():
     """
-    Checks if the embeddings database exists locally (in /tmp).
-    If not, downloads it from Google Cloud Storage.
+    Makes the embeddings available locally (in /tmp), downloading them from Google Cloud Storage:
+    the packed .npy pair when the bucket has it (memory-mapped, nothing to parse), else the SQLite database.
+    Skipped when EMBEDDINGS_DIR (e.g. a Cloud Storage volume mount) already provides the packed pair.
     Required for Cloud Run which has an ephemeral filesystem.
+    Blocking; the lifespan hook runs it in a worker thread.
     """
-    if os.path.exists(LOCAL_EMBEDDINGS_PATH):
-        print(f"[Startup] Found existing embeddings database at {LOCAL_EMBEDDINGS_PATH}")
+    if EMBEDDINGS_DIR and all(os.path.exists(os.path.join(EMBEDDINGS_DIR, name)) for name in EMBEDDINGS_NPY_BLOBS):
+        logger.info("Using packed embeddings from %s", EMBEDDINGS_DIR)
         return
 
-    print(f"[Startup] Downloading {EMBEDDINGS_BLOB} from bucket {EMBEDDINGS_BUCKET}...")
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(EMBEDDINGS_BUCKET)
-        blob = bucket.blob(EMBEDDINGS_BLOB)
-        blob.download_to_filename(LOCAL_EMBEDDINGS_PATH)
-        print(f"[Startup] Download complete: {LOCAL_EMBEDDINGS_PATH}")
+        bucket = storage.Client().bucket(EMBEDDINGS_BUCKET)
     except Exception as e:
-        print(f"[Startup] Failed to download embeddings: {e}")
-        # Depending on your logic, you might want to raise e here to stop the container
+        bucket = None
+        logger.warning("Could not access embeddings bucket: %s", e)
+
+    if bucket is not None:
+        # Ids last: vector_cache only uses the pair once both files are in place
+        if all(download_blob_if_needed(bucket, name, os.path.join(CLOUD_NPY_DIR, name)) for name in EMBEDDINGS_NPY_BLOBS):
+            return
+        if download_blob_if_needed(bucket, EMBEDDINGS_BLOB, LOCAL_EMBEDDINGS_PATH):
+            return
+
+    if os.path.exists(LOCAL_EMBEDDINGS_PATH):
+        logger.info("Found existing embeddings database at %s", LOCAL_EMBEDDINGS_PATH)
+        return
+    logger.error("Failed to download embeddings: gs://%s has neither packed nor SQLite embeddings", EMBEDDINGS_BUCKET)
 
 # ---------------------------------------------
 
 
-app = FastAPI(title="GroceryShopperAI Chat Backend")
+async def sweep_stale_websockets():
+    """Periodically evict half-open sockets so broadcasts don't fan out to dead peers"""
+    while True:
+        await asyncio.sleep(WS_SWEEP_INTERVAL_SECONDS)
+        try:
+            evicted = await manager.sweep_stale(WS_PING_INTERVAL_SECONDS + WS_PONG_TIMEOUT_SECONDS)
+            if evicted:
+                logger.info("Evicted %d stale WebSocket connection(s)", evicted)
+        except Exception:
+            logger.exception("WebSocket sweep failed")
+
+async def llm_worker():
+    """Drain llm_queue one job at a time; a failed job never kills the worker"""
+    while True:
+        args = await llm_queue.get()
+        try:
+            await maybe_answer_with_llm(*args)
+        except Exception:
+            logger.exception("LLM worker job failed")
+        finally:
+            llm_queue.task_done()
+
+def enqueue_llm_reply(content: str, room_id: int, user_id: int, preferred_model: Optional[str] = None):
+    try:
+        llm_queue.put_nowait((content, room_id, user_id, preferred_model))
+    except asyncio.QueueFull:
+        logger.warning("LLM queue full (%d), dropping reply for room %s", LLM_QUEUE_MAXSIZE, room_id)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fetch the vector DB in a worker thread so startup isn't blocked on the download;
+    # vector search picks the file up as soon as it lands
+    embeddings_download = asyncio.create_task(asyncio.to_thread(download_embeddings_if_needed))
+    try:
+        await init_db()
+        logger.info("DB initialized successfully")
+    except Exception:
+        logger.exception("Startup failed")
+
+    if REDIS_URL:
+        await manager.start_pubsub(REDIS_URL)
+    sweeper = asyncio.create_task(sweep_stale_websockets())
+    llm_workers = [asyncio.create_task(llm_worker()) for _ in range(LLM_WORKERS)]
+
+    yield
+
+    sweeper.cancel()
+    embeddings_download.cancel()
+    for worker in llm_workers:
+        worker.cancel()
+    await manager.stop_pubsub()
+    # Release pooled DB and LLM HTTP connections on shutdown / reload
+    await close_http_client()
+    await close_completion_cache()
+    await engine.dispose()
+
+
+app = FastAPI(title="GroceryShopperAI Chat Backend", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_origin_regex=CORS_LOCALHOST_REGEX,
+    allow_credentials=False,  # auth is a bearer header, not cookies
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=600,  # let browsers cache preflight responses
 )
+# Compress larger JSON bodies (message pages, shopping lists); SSE streams are left uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 manager = ConnectionManager()
 
@@ -105,30 +274,107 @@ class ShoppingListPayload(BaseModel):
     title: str
     items_json: str # JSON string of items list
 
-# --------- Dependencies ---------
-async def get_db() -> AsyncSession:
-    async with SessionLocal() as session:
-        yield session
-
 # --------- Utilities ---------
-async def broadcast_message(session: AsyncSession, msg: Message, room_id: int):
-    """Broadcast a message to all WebSocket clients connected to a room"""
-    username = None
-    if msg.user_id:
-        u = await session.get(User, msg.user_id)
-        username = u.username if u else "unknown"
+async def broadcast_message(msg: Message, room_id: int, username: Optional[str] = None):
+    """
+    Broadcast a message to all WebSocket clients connected to a room.
+    The caller passes the author's username (None for bot replies) so no lookup is needed.
+    """
     await manager.broadcast({
         "type": "message",
         "room_id": room_id,
         "message": {
             "id": msg.id,
-            "username": username if not msg.is_bot else "LLM Bot",
+            "username": "LLM Bot" if msg.is_bot else (username or "unknown"),
             "content": msg.content,
             "is_bot": msg.is_bot,
-            "created_at": str(msg.created_at)
+            # ISO 8601 up front: identical in JSON and msgpack frames, with or without the Redis round-trip
+            "created_at": msg.created_at.isoformat() if msg.created_at else None
         }
     }, room_id)
     
+async def load_chat_history(session: AsyncSession, room_id: int, limit: int = CHAT_HISTORY_LIMIT) -> List[dict]:
+    """
+    Most recent `limit` messages of a room as LLM chat turns, oldest first.
+    Bounded so AI commands in long-lived rooms don't scan (and prompt with) the whole history.
+    Memoized per room by (newest message id, message count): repeat commands only fetch what arrived since,
+    re-reading a small overlap so messages whose lower id committed late are picked up too.
+    Any mismatch the overlap can't explain (deletes, a late commit further back) reloads the window.
+    The result is trimmed to CHAT_HISTORY_TOKEN_BUDGET tokens, dropping the oldest turns first.
+    """
+    last_id, count = (await session.execute(
+        select(func.max(Message.id), func.count()).where(Message.room_id == room_id)
+    )).one()
+    if last_id is None:
+        return []
+
+    cached = _chat_history_cache.get(room_id)
+    if cached and cached[2] == limit and cached[0] == last_id and cached[1] == count:
+        return trim_history_to_token_budget([turn for _, turn in cached[3]], CHAT_HISTORY_TOKEN_BUDGET)
+
+    async def fetch(min_id: Optional[int] = None) -> List[Tuple[int, dict]]:
+        query = select(Message.id, Message.is_bot, Message.content).where(Message.room_id == room_id)
+        if min_id is not None:
+            query = query.where(Message.id > min_id)
+        res = await session.execute(query.order_by(desc(Message.id)).limit(limit))
+        return [
+            (msg_id, {"role": "assistant" if is_bot else "user", "content": content})
+            for msg_id, is_bot, content in reversed(res.all())
+        ]
+
+    entries = None
+    if cached and cached[2] == limit and last_id >= cached[0] and count > cached[1]:
+        # Only additions: merge the overlap with the cached window, then check every new message was found
+        known = {msg_id for msg_id, _ in cached[3]}
+        # With a full window, older rows in the overlap are ones that already fell out of it
+        floor = cached[3][0][0] if len(cached[3]) == limit else 0
+        fresh = [
+            e for e in await fetch(cached[0] - CHAT_HISTORY_OVERLAP_IDS)
+            if e[0] not in known and e[0] > floor
+        ]
+        if len(fresh) == count - cached[1]:
+            entries = sorted(cached[3] + fresh, key=lambda e: e[0])[-limit:]
+    if entries is None:
+        # Cold cache, different limit, deletes, or a late commit outside the overlap: reload the window
+        entries = await fetch()
+
+    if len(_chat_history_cache) >= CHAT_HISTORY_CACHE_MAX_ROOMS:
+        _chat_history_cache.clear()
+    _chat_history_cache[room_id] = (last_id, count, limit, entries)
+    return trim_history_to_token_budget([turn for _, turn in entries], CHAT_HISTORY_TOKEN_BUDGET)
+
+async def load_preferred_model(user_id: int, session: Optional[AsyncSession] = None) -> Optional[str]:
+    """
+    The user's preferred_llm_model, read fresh: the auth user cache is per process and leaves it out,
+    so a change is seen by every worker immediately. Uses its own session when none is given.
+    """
+    query = select(User.preferred_llm_model).where(User.id == user_id)
+    if session is not None:
+        return await session.scalar(query)
+    async with SessionLocal() as own_session:
+        return await own_session.scalar(query)
+
+async def load_room_ai_context(room_id: int) -> Tuple[List[str], List[dict]]:
+    """
+    Member usernames and recent chat history of a room, fetched concurrently.
+    Each query gets its own session since one connection can't run statements in parallel.
+    """
+    async def load_members() -> List[str]:
+        async with SessionLocal() as session:
+            res = await session.execute(
+                select(User.username)
+                .join(RoomMember, RoomMember.user_id == User.id)
+                .where(RoomMember.room_id == room_id)
+            )
+            return [row[0] for row in res.all()]
+
+    async def load_history() -> List[dict]:
+        async with SessionLocal() as session:
+            return await load_chat_history(session, room_id)
+
+    members, chat_history = await asyncio.gather(load_members(), load_history())
+    return members, chat_history
+
 async def broadcast_ai_event(room_id: int, event_type: str, narrative: str, payload: dict):
     """
     Sends a strutured AI event to frontend for rendering custom UI.
@@ -142,9 +388,48 @@ async def broadcast_ai_event(room_id: int, event_type: str, narrative: str, payl
     }, room_id)
     
 
-async def handle_inventory_command(content: str, room_id: int, user_id: int):
+# Reply to a bare "@inventory"
+INVENTORY_HELP_TEXT = (
+    "Let's load your inventory.\n\n"
+    "Reply with a message in the following format:\n"
+    "@inventory\n"
+    "product_name, stock_quantity, safety_stock_level\n\n"
+    "Example:\n"
+    "@inventory\n"
+    "Tomatoes, 50, 20   <-- Tomatoes = product name, 50 = current stock, 20 = safety stock threshold\n"
+    "Olive oil, 10, 3   <-- Olive oil = product name, 10 = current stock, 3 = safety stock threshold\n"
+    "Cheese, 5, 2\n\n"
+    "Make sure each item is on a separate line."
+)
+
+# One @inventory data line: "name, stock, safety_stock" (whitespace around fields is ignored)
+INVENTORY_LINE_RE = re.compile(r"([^,]+?)\s*,\s*([+-]?\d+)\s*,\s*([+-]?\d+)")
+
+async def upsert_inventory(session: AsyncSession, user_id: int, items: Dict[str, Tuple[int, int]]) -> None:
     """
-    Handle @inventory messages:
+    Insert or update a user's inventory rows in one statement (INSERT ... ON DUPLICATE KEY UPDATE
+    on the (user_id, product_name) unique key). items: product_name -> (stock, safety_stock_level).
+    Does not commit.
+    """
+    stmt = mysql_insert(Inventory).values([
+        {
+            "user_id": user_id,
+            "product_name": name,
+            "stock": stock_val,
+            "safety_stock_level": safety_val,
+        }
+        for name, (stock_val, safety_val) in items.items()
+    ])
+    stmt = stmt.on_duplicate_key_update(
+        stock=stmt.inserted.stock,
+        safety_stock_level=stmt.inserted.safety_stock_level,
+        updated_at=func.now(),  # Core statements skip the model's onupdate
+    )
+    await session.execute(stmt)
+
+async def handle_inventory_command(session: AsyncSession, content: str, room_id: int, user_id: int):
+    """
+    Handle @inventory messages (session is the caller's, one per routed message):
     - If only '@inventory' → send instructions
     - If '@inventory' plus lines → parse and upsert into Inventory table
     """
@@ -153,297 +438,270 @@ async def handle_inventory_command(content: str, room_id: int, user_id: int):
 
     # Case 1: Just '@inventory' → explain the format
     if not cleaned:
-        reply_text = (
-            "Let's load your inventory.\n\n"
-            "Reply with a message in the following format:\n"
-            "@inventory\n"
-            "product_name, stock_quantity, safety_stock_level\n\n"
-            "Example:\n"
-            "@inventory\n"
-            "Tomatoes, 50, 20   <-- Tomatoes = product name, 50 = current stock, 20 = safety stock threshold\n"
-            "Olive oil, 10, 3   <-- Olive oil = product name, 10 = current stock, 3 = safety stock threshold\n"
-            "Cheese, 5, 2\n\n"
-            "Make sure each item is on a separate line."
+        bot_msg = Message(
+            room_id=room_id,
+            user_id=None,
+            content=INVENTORY_HELP_TEXT,
+            is_bot=True,
         )
-        async with SessionLocal() as session:
-            bot_msg = Message(
-                room_id=room_id,
-                user_id=None,
-                content=reply_text,
-                is_bot=True,
-            )
-            session.add(bot_msg)
-            await session.commit()
-            await session.refresh(bot_msg)
-            await broadcast_message(session, bot_msg, room_id)
+        session.add(bot_msg)
+        await session.commit()
+        await session.refresh(bot_msg)
+        await broadcast_message(bot_msg, room_id)
         return
 
     # Case 2: @inventory plus data lines
-    lines = [line.strip() for line in cleaned.splitlines() if line.strip()]
     parsed_items = []
     errors = []
 
-    for line in lines:
-        parts = [p.strip() for p in line.split(",")]
-        if len(parts) != 3:
-            errors.append(f"- '{line}' (expected: name, stock, safety_stock)")
+    for line in cleaned.splitlines():
+        line = line.strip()
+        if not line:
             continue
 
-        name, stock_str, safety_str = parts
-        try:
-            stock_val = int(stock_str)
-            safety_val = int(safety_str)
-        except ValueError:
+        match = INVENTORY_LINE_RE.fullmatch(line)
+        if match:
+            parsed_items.append((match.group(1), int(match.group(2)), int(match.group(3))))
+        elif line.count(",") != 2:
+            errors.append(f"- '{line}' (expected: name, stock, safety_stock)")
+        else:
             errors.append(f"- '{line}' (stock and safety_stock must be integers)")
-            continue
 
-        parsed_items.append((name, stock_val, safety_val))
+    # Upsert every product for this user in one statement (keyed on uniq_user_product).
+    # A name repeated later in the paste wins, as it did with per-row updates
+    latest = {name: (stock_val, safety_val) for name, stock_val, safety_val in parsed_items}
+    if latest:
+        await upsert_inventory(session, user_id, latest)
 
-    async with SessionLocal() as session:
-        # Upsert per product for this user
-        for name, stock_val, safety_val in parsed_items:
-            res = await session.execute(
-                select(Inventory).where(
-                    (Inventory.user_id == user_id)
-                    & (Inventory.product_name == name)
-                )
-            )
-            inv = res.scalar_one_or_none()
-            if inv:
-                inv.stock = stock_val
-                inv.safety_stock_level = safety_val
-            else:
-                inv = Inventory(
-                    user_id=user_id,
-                    product_name=name,
-                    stock=stock_val,
-                    safety_stock_level=safety_val,
-                )
-                session.add(inv)
+    # Build confirmation message
+    msg_lines = []
+    if parsed_items:
+        msg_lines.append(f"✅ Saved/updated {len(parsed_items)} inventory item(s).")
+    if errors:
+        msg_lines.append("⚠️ Some lines could not be processed:\n" + "\n".join(errors))
 
-        await session.commit()
+    reply_text = "\n".join(msg_lines) if msg_lines else "No valid inventory lines were found."
 
-        # Build confirmation message
-        msg_lines = []
-        if parsed_items:
-            msg_lines.append(f"✅ Saved/updated {len(parsed_items)} inventory item(s).")
-        if errors:
-            msg_lines.append("⚠️ Some lines could not be processed:\n" + "\n".join(errors))
-
-        reply_text = "\n".join(msg_lines) if msg_lines else "No valid inventory lines were found."
-
-        bot_msg = Message(
-            room_id=room_id,
-            user_id=None,
-            content=reply_text,
-            is_bot=True,
-        )
-        session.add(bot_msg)
-        await session.commit()
-        await session.refresh(bot_msg)
-        await broadcast_message(session, bot_msg, room_id)
-        
+    bot_msg = Message(
+        room_id=room_id,
+        user_id=None,
+        content=reply_text,
+        is_bot=True,
+    )
+    session.add(bot_msg)
+    await session.commit()
+    await session.refresh(bot_msg)
+    await broadcast_message(bot_msg, room_id)
+    
 # AI Commands: @gro analyze / menu / restock (inventory + catalog)   
-async def handle_gro_command(kind: str, room_id: int, user_id: int):
+# Short chat message posted alongside each ai_event
+AI_EVENT_CHAT_TEXT = {
+    "inventory_analysis": "Generated inventory analysis for your current stock.",
+    "menu_suggestions": "Generated menu suggestions based on your inventory and items from grocery store.",
+    "restock_plan": "Generated a suggested restock plan.",
+}
+
+async def handle_gro_command(session: AsyncSession, kind: str, room_id: int, user_id: int, model_name: Optional[str]):
     """
     kind: "analyze", "menu", restock"
     Use inventory + grocery catalog (if needed), embeddings, and LLM modules.
     """
-    async with SessionLocal() as session:
-        # get user model
-        user = await session.get(User, user_id)
-        model_name = user.preferred_llm_model if user else "openai"
-        
-        # Load chat history for this room
-        msgs_res = await session.execute(
-            select(Message)
-            .where(Message.room_id == room_id)
-            .order_by(Message.created_at)
+    # Load recent chat history for this room
+    chat_history = await load_chat_history(session, room_id)
+    
+    # Load inventory
+    inv_res = await session.execute(
+        select(Inventory.product_name, Inventory.stock, Inventory.safety_stock_level)
+        .where(Inventory.user_id == user_id)
+    )
+    inventory_items = [
+        {
+            "product_name": row.product_name,
+            "stock": row.stock,
+            "safety_stock_level": row.safety_stock_level
+        }
+        for row in inv_res.all()
+    ]
+
+    # ---- Classify - Build low stock + healthy list ----
+    low_stock_items = [
+        item for item in inventory_items
+        if item["stock"] < item["safety_stock_level"]
+    ]
+    healthy_items = [
+        item for item in inventory_items
+        if item["stock"] >= item["safety_stock_level"]
+    ]
+    
+    # ---- Embedding matching (RAG Core) ----
+    # Strategies:
+    # 1. If it's "analyze" or "restock": similar items of "low_stock"
+    # 2. If it's "menu": we need to know the real items that correspond to "healthy_items"
+    # We do vector search for all invetory items.
+    
+    search_targets = []
+    if kind == "menu":
+        search_targets = inventory_items
+    else:
+        search_targets = low_stock_items
+    
+    # One concurrent search per target, one DB query for all matches
+    match_lists = await get_relevant_grocery_items_bulk(
+        session, [item["product_name"] for item in search_targets], limit=GROCERY_MATCHES_PER_ITEM
+    )
+
+    # Best match of every target first, then second-best, ... so the prompt cap trims the weakest
+    # matches rather than whole targets; deduplicated by title, only the fields the prompts use
+    slim: Dict[str, dict] = {}
+    for rank in range(GROCERY_MATCHES_PER_ITEM):
+        for matches in match_lists:
+            if rank < len(matches) and matches[rank].title not in slim:
+                m = matches[rank]
+                slim[m.title] = {"title": m.title, "price": float(m.price), "rating": m.rating_value or 0.0}
+    merged = list(slim.values())[:GROCERY_PROMPT_MAX_ITEMS]
+
+    # End the read transaction so the pooled connection is released while the LLM module runs
+    await session.commit()
+    
+    
+    # Run AI Module
+    if kind == "analyze":
+        ai_result = await analyze_inventory(
+            inventory_items=inventory_items, 
+            low_stock_items=low_stock_items, 
+            healthy_items=healthy_items, 
+            grocery_items=merged, 
+            chat_history=chat_history,
+            model_name=model_name,
         )
-        msgs = msgs_res.scalars().all()
-        
-        chat_history = [
-            {"role": "assistant" if m.is_bot else "user", "content": m.content}
-            for m in msgs
-        ]
+        event_type = "inventory_analysis"
         
-        # Load inventory
-        inv_res = await session.execute(
-            select(Inventory).where(Inventory.user_id == user_id)
+    elif kind == "restock":
+        ai_result = await generate_restock_plan(
+            low_stock_items=low_stock_items, 
+            grocery_items=merged, 
+            model_name=model_name
         )
-        inventory_items = [
-            {
-                "product_name": row.product_name,
-                "stock": row.stock,
-                "safety_stock_level": row.safety_stock_level
-            }
-            for row in inv_res.scalars().all()
-        ]
-
-        # ---- Classify - Build low stock + healthy list ----
-        low_stock_items = [
-            item for item in inventory_items
-            if item["stock"] < item["safety_stock_level"]
-        ]
-        healthy_items = [
-            item for item in inventory_items
-            if item["stock"] >= item["safety_stock_level"]
-        ]
-        
-        # ---- Embedding matching (RAG Core) ----
-        # Strategies:
-        # 1. If it's "analyze" or "restock": similar items of "low_stock"
-        # 2. If it's "menu": we need to know the real items that correspond to "healthy_items"
-        # We do vector search for all invetory items.
+        event_type = "restock_plan"
         
-        search_targets = []
-        if kind == "menu":
-            search_targets = inventory_items
-        else:
-            search_targets = low_stock_items
-        
-        grocery_items = []
-        for item in search_targets:
-            matches = await get_relevant_grocery_items(session, item["product_name"], limit=5)
-            for m in matches:
-                grocery_items.append({
-                    "title": m.title,
-                    "sub_category": m.sub_category,
-                    "price": float(m.price),
-                    "rating": m.rating_value or 0.0,
-                })
-
-        # remove duplicates by title
-        seen = set()
-        merged = []
-        for g in grocery_items:
-            if g["title"] not in seen:
-                seen.add(g["title"])
-                merged.append(g)
-        
-        
-        # Run AI Module
-        if kind == "analyze":
-            ai_result = await analyze_inventory(
-                inventory_items=inventory_items, 
-                low_stock_items=low_stock_items, 
-                healthy_items=healthy_items, 
-                grocery_items=merged, 
-                chat_history=chat_history,
-                model_name=model_name,
-            )
-            event_type = "inventory_analysis"
-            
-        elif kind == "restock":
-            ai_result = await generate_restock_plan(
-                low_stock_items=low_stock_items, 
-                grocery_items=merged, 
-                model_name=model_name
-            )
-            event_type = "restock_plan"
-            
-        elif kind == "menu":
-            ai_result = await generate_menu(
-                inventory_items=inventory_items, 
-                grocery_items=merged,
-                chat_history=chat_history,
-                model_name=model_name
-            )
-            event_type = "menu_suggestions"
+    elif kind == "menu":
+        # Dishes go out one by one while the menu is generated; the full ai_event follows as usual
+        dish_index = 0
 
-        else:
-            ai_result = {"narrative": "Unknown command.", "data": {}}
-            event_type = "unknown"
-            
-        narrative = ai_result.get("narrative", "AI suggestion generated.")
-        
-        await broadcast_ai_event(room_id, event_type, narrative, ai_result)
-        
-        # Send a short chat message as well
-        msg_text_map = {
-            "inventory_analysis": "Generated inventory analysis for your current stock.",
-            "menu_suggestions": "Generated menu suggestions based on your inventory and items from grocery store.",
-            "restock_plan": "Generated a suggested restock plan.",
-        }
-        bot_msg_text = msg_text_map.get(event_type, "AI suggestion generated.")
-        
-        bot_msg = Message(
-            room_id=room_id,
-            user_id=None,
-            content=bot_msg_text,
-            is_bot=True,
+        async def on_dish(dish: dict):
+            nonlocal dish_index
+            await manager.broadcast({
+                "type": "ai_event_item",
+                "event": "menu_suggestions",
+                "room_id": room_id,
+                "index": dish_index,
+                "item": dish,
+            }, room_id)
+            dish_index += 1
+
+        ai_result = await generate_menu(
+            inventory_items=inventory_items, 
+            grocery_items=merged,
+            chat_history=chat_history,
+            model_name=model_name,
+            on_dish=on_dish,
         )
-        session.add(bot_msg)
-        await session.commit()
-        await session.refresh(bot_msg)
-        await broadcast_message(session, bot_msg, room_id)
+        event_type = "menu_suggestions"
+
+    else:
+        ai_result = {"narrative": "Unknown command.", "data": {}}
+        event_type = "unknown"
+        
+    narrative = ai_result.get("narrative", "AI suggestion generated.")
+    
+    await broadcast_ai_event(room_id, event_type, narrative, ai_result)
+    
+    # Send a short chat message as well
+    bot_msg_text = AI_EVENT_CHAT_TEXT.get(event_type, "AI suggestion generated.")
+    
+    bot_msg = Message(
+        room_id=room_id,
+        user_id=None,
+        content=bot_msg_text,
+        is_bot=True,
+    )
+    session.add(bot_msg)
+    await session.commit()
+    await session.refresh(bot_msg)
+    await broadcast_message(bot_msg, room_id)
 
 # Router for @inventory / @gro commands / default LLM Chat
-async def maybe_answer_with_llm(content: str, room_id: int, user_id: int):
+# System prompt for plain @gro chat replies
+GRO_CHAT_SYSTEM_PROMPT = (
+    "You are a helpful assistant participating in a small group chat. "
+    "Provide concise, accurate answers suitable for a shared chat context. "
+    "Cite facts succinctly when helpful and avoid extremely long messages."
+)
+
+# (trigger, handle_gro_command kind), checked in order against the lowercased message
+GRO_COMMANDS = (
+    ("@gro analyze", "analyze"),
+    ("@gro menu", "menu"),
+    ("@gro restock", "restock"),
+)
+
+async def maybe_answer_with_llm(content: str, room_id: int, user_id: int, preferred_model: Optional[str] = None):
     """
-    Central logic:
+    Central logic (preferred_model is the sender's preferred_llm_model, resolved by the caller):
     - If message contains @inventory → handle inventory command (no LLM call)
     - @gro analyze/menu/restock -> AI modules + ai_event
     - @gro plan -> chat-based procurement_plan + ai_event
     - If message is plain @gro → call LLM as before
     """
-    if not content:
-        return
-    
-    # 1) Inventory flow
-    if "@inventory" in content.lower():
-        await handle_inventory_command(content, room_id, user_id)
-        # You can still allow @gro in the same message if you want,
-        # but simplest is to return here:
-        return
-    
-    # ==== AI Commands ====
-    if "@gro analyze" in content.lower():
-        await handle_gro_command("analyze", room_id, user_id)
-        return
-    
-    if "@gro menu" in content.lower():
-        await handle_gro_command("menu", room_id, user_id)
-        return
-    
-    if "@gro restock" in content.lower():
-        await handle_gro_command("restock", room_id, user_id)
+    if not content or "@" not in content:
         return
+    lowered = content.lower()
     
-    if "@gro plan" in content.lower():
-        async with SessionLocal() as session:
-            user = await session.get(User, user_id)
-            model_name = user.preferred_llm_model if user else "openai"
-            
-            msgs_res = await session.execute(
-                select(Message)
-                .where(Message.room_id == room_id)
-                .order_by(Message.created_at)
+    # One session for the whole routed message; handlers commit before waiting on an LLM
+    # so no pooled connection is held while a model runs
+    async with SessionLocal() as session:
+        # 1) Inventory flow
+        if "@inventory" in lowered:
+            await handle_inventory_command(session, content, room_id, user_id)
+            # You can still allow @gro in the same message if you want,
+            # but simplest is to return here:
+            return
+
+        # ==== AI Commands ====
+        for trigger, kind in GRO_COMMANDS:
+            if trigger in lowered:
+                await handle_gro_command(session, kind, room_id, user_id, preferred_model)
+                return
+
+        if "@gro plan" in lowered:
+            model_name = preferred_model
+            chat_history = await load_chat_history(session, room_id)
+            await session.commit()  # release the connection during the LLM call
+
+            # Generic List
+            plan_result = await generate_procurement_plan(chat_history=chat_history, model_name=model_name)
+
+            # RAG Enrichment: vector search for every keyword in list
+            enriched_items = []
+            plan_items = plan_result.get("items", [])
+            named_items = [item for item in plan_items if item.get("name")]
+            match_lists = await get_relevant_grocery_items_bulk(
+                session, [item["name"] for item in named_items], limit=1
             )
-            msgs = msgs_res.scalars().all()
-            chat_history = [
-                {"role": "assistant" if m.is_bot else "user", "content": m.content}
-                for m in msgs
-            ]
-        
-        # Generic List
-        plan_result = await generate_procurement_plan(chat_history=chat_history, model_name=model_name)
-        
-        # RAG Enrichment: vector search for every keyword in list
-        enriched_items = []
-        async with SessionLocal() as session:
-            for item in plan_result.get("items", []):
+            matches_by_item = {id(item): matches for item, matches in zip(named_items, match_lists)}
+
+            for item in plan_items:
                 raw_name = item.get("name")
-                
+
                 item["match_found"] = False
                 item["real_product"] = None
-                
+
                 if raw_name:
-                    matches = await get_relevant_grocery_items(session, raw_name, limit=1)
-                    
+                    matches = matches_by_item[id(item)]
+
                     if matches:
                         best_match = matches[0]
-                        
+
                         item["match_found"] = True
                         item["real_product"] = {
                             "id": best_match.id,
@@ -452,81 +710,90 @@ async def maybe_answer_with_llm(content: str, room_id: int, user_id: int):
                             "sub_category": best_match.sub_category,
                             "rating": best_match.rating_value or 0.0
                         }
-                        print(f"Matched '{raw_name}' -> '{best_match.title}'")
+                        logger.debug("Matched %r -> %r", raw_name, best_match.title)
                     else:
-                        print(f"No match found for '{raw_name}'")
-                
+                        logger.debug("No match found for %r", raw_name)
+
                 enriched_items.append(item)
-        
-        plan_result["items"] = enriched_items
-                
-        narrative = plan_result.get("narrative", "Here is your procurement plan.")
-        await broadcast_ai_event(room_id, "procurement_plan", narrative, plan_result)
-        return
-    
 
-    # 2) Regular LLM flow with @gro
-    if "@gro" not in content.lower():
-        return
+            plan_result["items"] = enriched_items
 
-    # Remove @gro tag from content before sending to LLM
-    llm_content = content.replace("@gro", "").strip()
-    system_prompt = (
-        "You are a helpful assistant participating in a small group chat. "
-        "Provide concise, accurate answers suitable for a shared chat context. "
-        "Cite facts succinctly when helpful and avoid extremely long messages."
-    )
+            narrative = plan_result.get("narrative", "Here is your procurement plan.")
+            await broadcast_ai_event(room_id, "procurement_plan", narrative, plan_result)
+            return
 
-    # Get user's preferred LLM model
-    async with SessionLocal() as temp_session:
-        user = await temp_session.get(User, user_id)
-        if user and user.preferred_llm_model:
-            model_name = user.preferred_llm_model
-        else:
-            model_name = "gemini"
 
-    try:
-        reply_text = await chat_completion(
-            [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": llm_content},
-            ],
-            model_name=model_name,
-        )
-    except Exception as e:
-        reply_text = f"(LLM error) {e}"
+        # 2) Regular LLM flow with @gro
+        if "@gro" not in lowered:
+            return
 
-    # Create new session for this async task
-    async with SessionLocal() as session:
-        bot_msg = Message(
-            room_id=room_id,
-            user_id=None,
-            content=reply_text,
-            is_bot=True,
-        )
-        session.add(bot_msg)
-        await session.commit()
-        await session.refresh(bot_msg)
-        await broadcast_message(session, bot_msg, room_id)
+        # Remove @gro tag from content before sending to LLM
+        llm_content = content.replace("@gro", "").strip()
+        system_prompt = GRO_CHAT_SYSTEM_PROMPT
+
+        model_name = preferred_model or "gemini"
+
+        # The session has not touched the DB yet, so no connection is held while streaming
+        cache_key = reply_cache_key(system_prompt, model_name, llm_content)
+        reply_text = get_cached_reply(cache_key)
+        stream_id = None
+        if reply_text is None:
+            # Stream deltas to the room as they arrive; the full reply is stored and broadcast at the end
+            stream_id = uuid.uuid4().hex
+            parts = []
+            try:
+                async for delta in chat_completion_stream(
+                    [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": llm_content},
+                    ],
+                    model_name=model_name,
+                ):
+                    parts.append(delta)
+                    await manager.broadcast({
+                        "type": "message_chunk",
+                        "room_id": room_id,
+                        "stream_id": stream_id,
+                        "delta": delta,
+                    }, room_id)
+                reply_text = "".join(parts)
+                if reply_text:
+                    set_cached_reply(cache_key, reply_text)
+            except Exception as e:
+                reply_text = f"(LLM error) {e}"
+
+        bot_msg = None
+        if reply_text:
+            bot_msg = Message(
+                room_id=room_id,
+                user_id=None,
+                content=reply_text,
+                is_bot=True,
+            )
+            session.add(bot_msg)
+            await session.commit()
+            await session.refresh(bot_msg)
+            await broadcast_message(bot_msg, room_id)
+        else:
+            # Nothing came back (e.g. every chunk filtered): no empty bot message, nothing cached
+            logger.warning("Empty @gro reply in room %s, not stored", room_id)
+
+        if stream_id:
+            # message_id is None when there was no reply, so clients can drop the streamed placeholder
+            await manager.broadcast({
+                "type": "message_done",
+                "room_id": room_id,
+                "stream_id": stream_id,
+                "message_id": bot_msg.id if bot_msg else None,
+            }, room_id)
     
 
 # --------- Routes ---------
-@app.on_event("startup")
-async def on_startup():
-    try:
-        # Download the vector DB first
-        download_embeddings_if_needed()
-        
-        await init_db()
-        print("DB initialized successfully")
-    except Exception as e:
-        print(f"Startup failed: {e}")
-
 @app.post("/api/signup")
 async def signup(payload: AuthPayload, session: AsyncSession = Depends(get_db)):
     """Create a new user"""
-    existing = await session.execute(select(User).where(User.username == payload.username))
-    if existing.scalar_one_or_none():
+    existing_id = await session.scalar(select(User.id).where(User.username == payload.username))
+    if existing_id is not None:
         raise HTTPException(status_code=400, detail="Username already taken")
     
     u = User(
@@ -536,7 +803,6 @@ async def signup(payload: AuthPayload, session: AsyncSession = Depends(get_db)):
     )
     session.add(u)
     await session.commit()
-    await session.refresh(u)
     
     token = create_access_token({"sub": u.username})
     return {"ok": True, "token": token}
@@ -544,75 +810,59 @@ async def signup(payload: AuthPayload, session: AsyncSession = Depends(get_db)):
 @app.post("/api/login")
 async def login(payload: AuthPayload, session: AsyncSession = Depends(get_db)):
     """Login and return authentication token"""
-    res = await session.execute(select(User).where(User.username == payload.username))
-    u = res.scalar_one_or_none()
-    if not u or not verify_password(payload.password, u.password_hash):
+    # Only the two columns login needs; no ORM instance is built
+    res = await session.execute(
+        select(User.username, User.password_hash).where(User.username == payload.username)
+    )
+    row = res.first()
+    if not row or not verify_password(payload.password, row.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_access_token({"sub": u.username})
+    token = create_access_token({"sub": row.username})
     return {"ok": True, "token": token}
 
 @app.get("/api/rooms")
-async def get_rooms(username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def get_rooms(u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Get all rooms that the user is a member of (excluding soft-deleted)"""
     try:
-        print(f"[GetRooms] Fetching rooms for user: {username}")
-        
-        res = await session.execute(select(User).where(User.username == username))
-        u = res.scalar_one_or_none()
-        if not u:
-            print(f"[GetRooms] User {username} not found")
-            raise HTTPException(status_code=401, detail="Invalid user")
-        
-        print(f"[GetRooms] User {username} (id={u.id}) found")
+        logger.debug("GetRooms: fetching rooms for user %s (id=%s)", u.username, u.id)
         
         # Get all rooms this user is a member of and NOT deleted
         member_res = await session.execute(
-            select(Room).join(RoomMember).where(
+            select(Room.id, Room.name, Room.created_at).join(RoomMember).where(
                 (RoomMember.user_id == u.id) & (RoomMember.deleted_at == None)
             )
         )
-        rooms = member_res.scalars().all()
-        print(f"[GetRooms] Found {len(rooms)} active rooms for user {username}")
+        rooms = member_res.all()
+        logger.debug("GetRooms: found %d active rooms for user %s", len(rooms), u.username)
         
         return {
-            "rooms": [{"id": r.id, "name": r.name, "created_at": str(r.created_at)} for r in rooms]
+            "rooms": [{"id": r.id, "name": r.name, "created_at": r.created_at} for r in rooms]
         }
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[GetRooms] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("GetRooms failed")
         raise HTTPException(status_code=500, detail=f"Failed to fetch rooms: {str(e)}")
 
 @app.post("/api/rooms")
-async def create_room(payload: RoomPayload, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def create_room(payload: RoomPayload, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Create a new room"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
     # Check if room name already exists
-    existing = await session.execute(select(Room).where(Room.name == payload.name))
-    if existing.scalar_one_or_none():
+    existing_id = await session.scalar(select(Room.id).where(Room.name == payload.name))
+    if existing_id is not None:
         raise HTTPException(status_code=400, detail="Room name already taken")
     
-    # Create room
+    # Create room and add creator in a single transaction; flush assigns room.id
     room = Room(name=payload.name, owner_id=u.id)
     session.add(room)
-    await session.commit()
-    await session.refresh(room)
-    
-    # Add creator to room
-    member = RoomMember(room_id=room.id, user_id=u.id)
-    session.add(member)
+    await session.flush()
+    session.add(RoomMember(room_id=room.id, user_id=u.id))
     await session.commit()
     
     return {"ok": True, "room": {"id": room.id, "name": room.name}}
 
 @app.delete("/api/rooms/{room_id}")
-async def delete_room(room_id: int, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def delete_room(room_id: int, user: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """
     Soft-delete a room for the current user
     - Marks the room as deleted for this user (deleted_at = now())
@@ -622,184 +872,148 @@ async def delete_room(room_id: int, username: str = Depends(get_current_user_tok
     from datetime import datetime
     
     try:
-        print(f"[DeleteRoom] User {username} attempting to delete room {room_id}")
+        logger.debug("DeleteRoom: user %s (id=%s) attempting to delete room %s", user.username, user.id, room_id)
         
-        # Get current user
-        res = await session.execute(select(User).where(User.username == username))
-        user = res.scalar_one_or_none()
-        if not user:
-            print(f"[DeleteRoom] User {username} not found")
-            raise HTTPException(status_code=401, detail="Invalid user")
-        
-        print(f"[DeleteRoom] Found user: {user.username} (id={user.id})")
-        
-        # Check if room exists
-        room = await session.get(Room, room_id)
-        if not room:
-            print(f"[DeleteRoom] Room {room_id} not found")
-            raise HTTPException(status_code=404, detail="Room not found")
-        
-        print(f"[DeleteRoom] Found room: {room.name} (id={room.id})")
-        
-        # Get the room member entry for this user
-        member_res = await session.execute(
-            select(RoomMember).where(
-                (RoomMember.room_id == room_id) & (RoomMember.user_id == user.id)
-            )
+        # Soft-delete: mark this user's membership as deleted in one statement
+        logger.debug("DeleteRoom: marking room %s as deleted for user %s", room_id, user.id)
+        marked = await session.execute(
+            update(RoomMember)
+            .where((RoomMember.room_id == room_id) & (RoomMember.user_id == user.id))
+            .values(deleted_at=datetime.utcnow())
         )
-        member = member_res.scalar_one_or_none()
-        if not member:
-            print(f"[DeleteRoom] User {user.id} is not a member of room {room_id}")
+        if marked.rowcount == 0:
+            # Nothing matched: tell a missing room apart from a non-member
+            if await session.scalar(select(Room.id).where(Room.id == room_id)) is None:
+                logger.debug("DeleteRoom: room %s not found", room_id)
+                raise HTTPException(status_code=404, detail="Room not found")
+            logger.debug("DeleteRoom: user %s is not a member of room %s", user.id, room_id)
             raise HTTPException(status_code=404, detail="User is not a member of this room")
         
-        print(f"[DeleteRoom] Found membership: room_id={member.room_id}, user_id={member.user_id}")
-        
-        # Soft-delete: mark as deleted
-        print(f"[DeleteRoom] Marking room {room_id} as deleted for user {user.id}")
-        member.deleted_at = datetime.utcnow()
-        session.add(member)
-        await session.commit()
-        print(f"[DeleteRoom] Successfully marked room {room_id} as deleted for user {user.id}")
-        
         # Check if all members have deleted this room
-        active_members = await session.execute(
-            select(RoomMember).where(
+        has_active_member = await session.scalar(
+            select(literal(1)).where(
                 (RoomMember.room_id == room_id) & (RoomMember.deleted_at == None)
-            )
+            ).limit(1)
         )
-        active_members_list = active_members.scalars().all()
         
-        print(f"[DeleteRoom] Active members count: {len(active_members_list)}")
+        if has_active_member is None:
+            # No active members, delete room; the database cascades to its messages and memberships
+            logger.info("DeleteRoom: no active members left, permanently deleting room %s", room_id)
+            await session.execute(delete(Room).where(Room.id == room_id))
         
-        if not active_members_list:
-            # No active members, delete room and all messages
-            print(f"[DeleteRoom] No active members left, permanently deleting room {room_id}")
-            await session.delete(room)
-            await session.commit()
-            print(f"[DeleteRoom] Room {room_id} permanently deleted")
+        await session.commit()
+        logger.debug("DeleteRoom: marked room %s as deleted for user %s", room_id, user.id)
         
-        print(f"[DeleteRoom] Operation completed successfully for room {room_id}")
+        logger.debug("DeleteRoom: completed for room %s", room_id)
         return {"ok": True, "message": "Room deleted for you"}
     
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[DeleteRoom] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("DeleteRoom failed")
         raise HTTPException(status_code=500, detail=f"Failed to delete room: {str(e)}")
 
 @app.get("/api/rooms/{room_id}/members")
 async def get_room_members(room_id: int, session: AsyncSession = Depends(get_db)):
     """Get members of a room"""
-    room = await session.get(Room, room_id)
-    if not room:
+    if await session.scalar(select(Room.id).where(Room.id == room_id)) is None:
         raise HTTPException(status_code=404, detail="Room not found")
     
     members_res = await session.execute(
-        select(User).join(RoomMember).where(RoomMember.room_id == room_id)
+        select(User.id, User.username).join(RoomMember).where(RoomMember.room_id == room_id)
     )
-    members = members_res.scalars().all()
+    members = members_res.all()
     return {
         "members": [{"id": m.id, "username": m.username} for m in members]
     }
 
 @app.post("/api/rooms/{room_id}/invite")
-async def invite_to_room(room_id: int, payload: InvitePayload, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def invite_to_room(room_id: int, payload: InvitePayload, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Invite a user to a room"""
     # Check if invoker is room owner
-    room = await session.get(Room, room_id)
-    if not room:
+    owner_id = await session.scalar(select(Room.owner_id).where(Room.id == room_id))
+    if owner_id is None:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u or room.owner_id != u.id:
+    if owner_id != u.id:
         raise HTTPException(status_code=403, detail="Only room owner can invite")
     
     # Get user to invite
-    invite_res = await session.execute(select(User).where(User.username == payload.username))
-    invite_user = invite_res.scalar_one_or_none()
-    if not invite_user:
+    invite_user_id = await session.scalar(select(User.id).where(User.username == payload.username))
+    if invite_user_id is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check if already member
-    member_check = await session.execute(
-        select(RoomMember).where(
+    already_member = await session.scalar(
+        select(literal(1)).where(
             (RoomMember.room_id == room_id) & 
-            (RoomMember.user_id == invite_user.id)
-        )
+            (RoomMember.user_id == invite_user_id)
+        ).limit(1)
     )
-    if member_check.scalar_one_or_none():
+    if already_member is not None:
         raise HTTPException(status_code=400, detail="User already in room")
     
     # Add user to room
-    member = RoomMember(room_id=room_id, user_id=invite_user.id)
+    member = RoomMember(room_id=room_id, user_id=invite_user_id)
     session.add(member)
     await session.commit()
     
     return {"ok": True, "message": f"User {payload.username} added to room"}
 
 @app.get("/api/rooms/{room_id}/messages")
-async def get_room_messages(room_id: int, limit: int = 50, session: AsyncSession = Depends(get_db)):
-    """Get messages from a specific room"""
-    room = await session.get(Room, room_id)
-    if not room:
+async def get_room_messages(room_id: int, limit: int = 50, before_id: Optional[int] = None, session: AsyncSession = Depends(get_db)):
+    """Get messages from a specific room (pass before_id to page back through older history)"""
+    if await session.scalar(select(Room.id).where(Room.id == room_id)) is None:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    res = await session.execute(
-        select(Message)
+    # Keyset pagination on the primary key: the newest `limit` messages older than before_id.
+    # Authors are resolved in the same round-trip instead of one lookup per message
+    query = (
+        select(Message, User.username)
+        .outerjoin(User, Message.user_id == User.id)
         .where(Message.room_id == room_id)
-        .order_by(desc(Message.created_at))
-        .limit(limit)
     )
-    items = list(reversed(res.scalars().all()))
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    res = await session.execute(query.order_by(desc(Message.id)).limit(limit))
+    items = res.all()
+    items.reverse()  # oldest first, in place
     out = []
-    for m in items:
-        username = None
-        if not m.is_bot and m.user_id:
-            u = await session.get(User, m.user_id)
-            username = u.username if u else "unknown"
+    for m, username in items:
         out.append({
             "id": m.id,
             "username": "LLM Bot" if m.is_bot else (username or "unknown"),
             "content": m.content,
             "is_bot": m.is_bot,
-            "created_at": str(m.created_at)
+            "created_at": m.created_at
         })
     return {"messages": out}
 
 @app.post("/api/rooms/{room_id}/messages")
-async def post_room_message(room_id: int, payload: MessagePayload, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def post_room_message(room_id: int, payload: MessagePayload, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Post a message to a specific room"""
     try:
         # Check if room exists
-        room = await session.get(Room, room_id)
-        if not room:
+        if await session.scalar(select(Room.id).where(Room.id == room_id)) is None:
             raise HTTPException(status_code=404, detail="Room not found")
         
-        # Get user
-        res = await session.execute(select(User).where(User.username == username))
-        u = res.scalar_one_or_none()
-        if not u:
-            raise HTTPException(status_code=401, detail="Invalid user")
-        
         # Check if user is member of room (including soft-deleted members)
+        # Only the columns needed here; no RoomMember instance is hydrated
         member_check = await session.execute(
-            select(RoomMember).where(
+            select(RoomMember.id, RoomMember.deleted_at).where(
                 (RoomMember.room_id == room_id) & 
                 (RoomMember.user_id == u.id)
-            )
+            ).limit(1)
         )
-        member = member_check.scalar_one_or_none()
+        member = member_check.first()
         if not member:
             raise HTTPException(status_code=403, detail="Not a member of this room")
         
         # If user had deleted this room, reactivate it (undelete)
         if member.deleted_at is not None:
-            member.deleted_at = None
-            session.add(member)
-            await session.commit()
+            await session.execute(
+                update(RoomMember).where(RoomMember.id == member.id).values(deleted_at=None)
+            )
         
         # Create message
         m = Message(room_id=room_id, user_id=u.id, content=payload.content, is_bot=False)
@@ -807,78 +1021,61 @@ async def post_room_message(room_id: int, payload: MessagePayload, username: str
         await session.commit()
         await session.refresh(m)
         
-        await broadcast_message(session, m, room_id)
-        asyncio.create_task(maybe_answer_with_llm(payload.content, room_id, u.id))
+        await broadcast_message(m, room_id, u.username)
+        # Every command starts with "@" (@gro / @inventory); plain chat never reaches the queue
+        if "@" in payload.content:
+            enqueue_llm_reply(payload.content, room_id, u.id, await load_preferred_model(u.id, session))
         
         return {"ok": True, "id": m.id}
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error in post_room_message: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in post_room_message")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/users/llm-model")
-async def get_llm_model(username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db), platform: str = "desktop"):
+async def get_llm_model(u: User = Depends(get_current_user), platform: str = "desktop", session: AsyncSession = Depends(get_db)):
     """Get user's preferred LLM model and check availability
     
     models: openai, gemini
     """
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
-    available_models = list(AVAILABLE_MODELS.keys())
-    gemini_available = bool(AVAILABLE_MODELS.get("gemini", {}).get("api_key"))
-    
-    current_model = "openai" if u.preferred_llm_model not in available_models else u.preferred_llm_model
+    preferred = await load_preferred_model(u.id, session)
+    current_model = "openai" if preferred not in VALID_LLM_MODELS else preferred
     
     return {
         "model": current_model,
-        "available_models": available_models,
-        "gemini_available": gemini_available,
+        "available_models": LLM_MODEL_NAMES,
+        "gemini_available": GEMINI_AVAILABLE,
         "platform": platform,
         "gemini_instructions": "Set GEMINI_API_KEY and GEMINI_MODEL in backend env to enable Gemini"
     }
 
 @app.put("/api/users/llm-model")
-async def update_llm_model(payload: dict, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def update_llm_model(payload: dict, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Update user's preferred LLM model"""
     model_name = payload.get("model")
     if not model_name:
         raise HTTPException(status_code=400, detail="model is required")
     
-    # Validate if model exists
-    valid_models = list(AVAILABLE_MODELS.keys())
-    if model_name not in valid_models:
-        raise HTTPException(status_code=400, detail=f"Invalid model. Choose from: {valid_models}")
-    
-    # Get user and update model preference
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
+    # Validate before touching the DB
+    if model_name not in VALID_LLM_MODELS:
+        raise HTTPException(status_code=400, detail=f"Invalid model. Choose from: {LLM_MODEL_NAMES}")
     
-    u.preferred_llm_model = model_name
-    session.add(u)
+    # Single UPDATE; `u` is a cached, read-only copy, so no row needs loading
+    await session.execute(update(User).where(User.id == u.id).values(preferred_llm_model=model_name))
     await session.commit()
     
     return {"ok": True, "model": model_name}
 
 @app.get("/api/inventory")
-async def get_inventory(username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def get_inventory(u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Get user's inventory"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
     inv_res = await session.execute(
-        select(Inventory).where(Inventory.user_id == u.id).order_by(Inventory.product_name)
+        select(Inventory.product_id, Inventory.product_name, Inventory.stock, Inventory.safety_stock_level)
+        .where(Inventory.user_id == u.id)
+        .order_by(Inventory.product_name)
     )
-    items = inv_res.scalars().all()
+    items = inv_res.all()
     
     return {
         "items": [
@@ -893,91 +1090,76 @@ async def get_inventory(username: str = Depends(get_current_user_token), session
     }
 
 @app.post("/api/inventory")
-async def upsert_inventory_item(payload: InventoryItemPayload, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def upsert_inventory_item(payload: InventoryItemPayload, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Add or update an inventory item"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
-    # Check if item exists
-    existing_res = await session.execute(
-        select(Inventory).where(
-            (Inventory.user_id == u.id) & (Inventory.product_name == payload.product_name)
-        )
-    )
-    existing = existing_res.scalar_one_or_none()
-    
-    if existing:
-        existing.stock = payload.stock
-        existing.safety_stock_level = payload.safety_stock_level
-        session.add(existing)
-    else:
-        new_item = Inventory(
-            user_id=u.id,
-            product_name=payload.product_name,
-            stock=payload.stock,
-            safety_stock_level=payload.safety_stock_level
-        )
-        session.add(new_item)
-    
+    await upsert_inventory(session, u.id, {payload.product_name: (payload.stock, payload.safety_stock_level)})
     await session.commit()
     return {"ok": True}
 
+@app.post("/api/inventory/bulk")
+async def bulk_upsert_inventory(payload: List[InventoryItemPayload], u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
+    """Add or update many inventory items in one statement (a repeated product_name: last one wins)"""
+    items = {item.product_name: (item.stock, item.safety_stock_level) for item in payload}
+    if items:
+        await upsert_inventory(session, u.id, items)
+        await session.commit()
+    return {"ok": True, "count": len(items)}
+
 @app.delete("/api/inventory/{product_id}")
-async def delete_inventory_item(product_id: int, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def delete_inventory_item(product_id: int, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Delete an inventory item"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
-    item = await session.get(Inventory, product_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-        
-    if item.user_id != u.id:
+    # Ownership is part of the WHERE clause, so the common case is a single statement
+    result = await session.execute(
+        delete(Inventory).where((Inventory.product_id == product_id) & (Inventory.user_id == u.id))
+    )
+    if result.rowcount == 0:
+        owner_id = await session.scalar(select(Inventory.user_id).where(Inventory.product_id == product_id))
+        if owner_id is None:
+            raise HTTPException(status_code=404, detail="Item not found")
         raise HTTPException(status_code=403, detail="Not authorized")
         
-    await session.delete(item)
     await session.commit()
     return {"ok": True}
-    return {"ok": True}
+
+def _decode_shopping_list_items(list_id: int, items_json: str):
+    """Stored items as JSON; rows written before POST validated them may be empty or invalid, and read as []"""
+    try:
+        return orjson.loads(items_json)
+    except orjson.JSONDecodeError:
+        logger.warning("Shopping list %s has invalid items_json, returning []", list_id)
+        return []
 
 @app.get("/api/shopping-lists")
-async def get_shopping_lists(username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def get_shopping_lists(u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Get user's shopping lists"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
     lists_res = await session.execute(
-        select(ShoppingList)
+        select(ShoppingList.id, ShoppingList.title, ShoppingList.items_json, ShoppingList.created_at)
         .where((ShoppingList.user_id == u.id) & (ShoppingList.is_archived == False))
         .order_by(desc(ShoppingList.created_at))
     )
-    lists = lists_res.scalars().all()
+    lists = lists_res.all()
     
-    return {
+    # Rendered directly by orjson, skipping FastAPI's jsonable_encoder pass
+    return ORJSONResponse({
         "lists": [
             {
                 "id": l.id,
                 "title": l.title,
-                "items_json": l.items_json,
-                "created_at": str(l.created_at)
+                "items": _decode_shopping_list_items(l.id, l.items_json),
+                "created_at": l.created_at
             }
             for l in lists
         ]
-    }
+    })
 
 @app.post("/api/shopping-lists")
-async def create_shopping_list(payload: ShoppingListPayload, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def create_shopping_list(payload: ShoppingListPayload, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Create a new shopping list"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
+    # Reject invalid JSON up front so the stored text always decodes on read
+    try:
+        orjson.loads(payload.items_json)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="items_json must be valid JSON")
     
     new_list = ShoppingList(
         user_id=u.id,
@@ -991,46 +1173,76 @@ async def create_shopping_list(payload: ShoppingListPayload, username: str = Dep
     return {"ok": True, "id": new_list.id}
 
 @app.delete("/api/shopping-lists/{list_id}")
-async def archive_shopping_list(list_id: int, username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)):
+async def archive_shopping_list(list_id: int, u: User = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
     """Archive (soft delete) a shopping list"""
-    res = await session.execute(select(User).where(User.username == username))
-    u = res.scalar_one_or_none()
-    if not u:
-        raise HTTPException(status_code=401, detail="Invalid user")
-    
-    lst = await session.get(ShoppingList, list_id)
-    if not lst:
-        raise HTTPException(status_code=404, detail="List not found")
-        
-    if lst.user_id != u.id:
+    # Ownership is part of the WHERE clause, so the common case is a single statement
+    result = await session.execute(
+        update(ShoppingList)
+        .where((ShoppingList.id == list_id) & (ShoppingList.user_id == u.id))
+        .values(is_archived=True)
+    )
+    if result.rowcount == 0:
+        owner_id = await session.scalar(select(ShoppingList.user_id).where(ShoppingList.id == list_id))
+        if owner_id is None:
+            raise HTTPException(status_code=404, detail="List not found")
         raise HTTPException(status_code=403, detail="Not authorized")
         
-    lst.is_archived = True
-    session.add(lst)
     await session.commit()
     return {"ok": True}
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+
+@app.websocket("/ws/{room_id}")
+async def websocket_endpoint(websocket: WebSocket, room_id: int):
     """WebSocket endpoint that groups connections by room_id"""
-    # Extract room_id from query parameters
-    room_id_str = websocket.query_params.get("room_id")
-    if not room_id_str:
-        await websocket.close(code=1008, reason="room_id required")
+    # Authenticate and check membership during the handshake, before a socket slot is taken
+    token = websocket.query_params.get("token")
+    if not token:
+        await websocket.close(code=1008, reason="token required")
         return
     
     try:
-        room_id = int(room_id_str)
-    except ValueError:
-        await websocket.close(code=1008, reason="room_id must be integer")
+        username = decode_access_token(token)
+    except HTTPException:
+        await websocket.close(code=1008, reason="Invalid token")
+        return
+    
+    async with SessionLocal() as session:
+        member_id = await session.scalar(
+            select(RoomMember.id)
+            .join(User, RoomMember.user_id == User.id)
+            .where((RoomMember.room_id == room_id) & (User.username == username))
+            .limit(1)
+        )
+    if member_id is None:
+        await websocket.close(code=1008, reason="Not a member of this room")
         return
     
+    # Wire format: JSON text frames by default, MessagePack binary frames with ?format=msgpack
+    fmt = websocket.query_params.get("format", "json")
+    if fmt not in WS_FORMATS:
+        await websocket.close(code=1008, reason=f"format must be one of {list(WS_FORMATS)}")
+        return
+    
+    # ?batch=1: messages arriving within a few ms are coalesced into one array frame
+    coalesce = websocket.query_params.get("batch") in ("1", "true")
+    
     try:
-        await manager.connect(websocket, room_id)
+        await manager.connect(websocket, room_id, fmt, coalesce=coalesce)
         try:
             while True:
-                await websocket.receive_text()
+                try:
+                    # Any inbound frame, text or binary (msgpack clients), counts as liveness
+                    frame = await asyncio.wait_for(websocket.receive(), timeout=WS_PING_INTERVAL_SECONDS)
+                    if frame["type"] == "websocket.disconnect":
+                        break
+                    manager.touch(websocket)
+                except asyncio.TimeoutError:
+                    # Quiet socket: ping it, and drop it if the previous ping went unanswered
+                    if time.monotonic() - manager.last_seen.get(websocket, 0) > WS_PING_INTERVAL_SECONDS + WS_PONG_TIMEOUT_SECONDS:
+                        await websocket.close(code=1001)
+                        break
+                    await manager.send_personal({"type": "ping"}, websocket)
         except Exception as e:
-            print(f"WebSocket error: {e}")
+            logger.debug("WebSocket closed: %s", e)
     finally:
         manager.disconnect(websocket, room_id)
 
@@ -1040,90 +1252,108 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 # --------- LLM functions ---------
+async def run_coalesced(key: tuple, factory):
+    """
+    Await factory() once per key: callers arriving while it runs share the same result.
+    Shielded, so one client disconnecting doesn't cancel the call for the others.
+    """
+    fut = _inflight_ai.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(factory())
+        _inflight_ai[key] = fut
+        fut.add_done_callback(lambda _: _inflight_ai.pop(key, None))
+    return await asyncio.shield(fut)
+
+def ai_context_key(kind: str, room_id: int, model_name: Optional[str], goal: Optional[str], members: List[str], chat_history: List[dict]) -> tuple:
+    context = hash((tuple(members), tuple((m["role"], m["content"]) for m in chat_history)))
+    return (kind, room_id, model_name, goal or "", context)
+
+def sse_event(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, default=str) + b"\n\n"
+
+async def stream_ai_result(run):
+    """
+    Server-Sent Events for an AI endpoint: one "token" event per model delta ({"delta": ...}),
+    then a single "result" event carrying the same body as the non-streaming response
+    (or an "error" event). All DB work must be done before this starts.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_token(delta: str):
+        await queue.put(("token", {"delta": delta}))
+
+    async def produce():
+        try:
+            await queue.put(("result", await run(on_token)))
+        except Exception as e:
+            logger.exception("Streaming AI request failed")
+            await queue.put(("error", {"detail": str(e)}))
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            yield sse_event(*item)
+    finally:
+        producer.cancel()
+
 # Planning
 @app.post("/api/rooms/{room_id}/ai-plan")
-async def api_generate_plan(room_id: int, payload: AIPlanPayload = Body(...), username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db),):
+async def api_generate_plan(room_id: int, payload: AIPlanPayload = Body(...), stream: bool = False, u: User = Depends(get_current_user),):
     """
     Generate an AI-generated group plan for a room.
     Goal is optional - if not provided, it will be inferred from chat history.
+    With ?stream=true the response is Server-Sent Events (see stream_ai_result).
     """
     
     override_goal = payload.goal  # optional override from frontend
     
-    res = await session.execute(select(User).where(User.username == username))
-    user = res.scalar_one_or_none()
-    model_name = user.preferred_llm_model if user else "openai"
+    (members, chat_history), model_name = await asyncio.gather(load_room_ai_context(room_id), load_preferred_model(u.id))
     
-    members_res = await session.execute(
-        select(User.username)
-        .join(RoomMember, RoomMember.user_id == User.id)
-        .where(RoomMember.room_id == room_id)
-    )
-    members = [row[0] for row in members_res.fetchall()]
-    
-    msgs_res = await session.execute(
-        select(Message)
-        .where(Message.room_id == room_id)
-        .order_by(Message.created_at)
-    )
-    msgs = msgs_res.scalars().all()
-    
-    chat_history = []
-    for m in msgs:
-        role = "assistant" if m.is_bot else "user"
-        chat_history.append({"role": role, "content": m.content})
-        
-    plan = await generate_group_plan(
-        chat_history=chat_history,
-        goal=override_goal,
-        members=members,
-        model_name=model_name,
-    )
+    async def run(on_token=None):
+        plan = await generate_group_plan(
+            chat_history=chat_history,
+            goal=override_goal,
+            members=members,
+            model_name=model_name,
+            on_token=on_token,
+        )
+        return {"plan": plan}
     
-    return {"plan": plan}
+    if stream:
+        return StreamingResponse(stream_ai_result(run), media_type="text/event-stream")
+    key = ai_context_key("plan", room_id, model_name, override_goal, members, chat_history)
+    return await run_coalesced(key, run)
 
 # Matching Suggestion
 @app.post("/api/rooms/{room_id}/ai-matching")
-async def api_generate_matching(room_id: int, payload: AIMatchingPayload = Body(...), username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db),):
+async def api_generate_matching(room_id: int, payload: AIMatchingPayload = Body(...), stream: bool = False, u: User = Depends(get_current_user),):
     """
     AI Matching Suggestion module:
     - Extract goal automatically unless provided by frontend
     - Detect assigned members from chat history
     - Suggest available members or missing roles
+    With ?stream=true the response is Server-Sent Events (see stream_ai_result).
     """
     
     override_goal = payload.goal
     
-    res = await session.execute(select(User).where(User.username == username))
-    user = res.scalar_one_or_none()
-    model_name = user.preferred_llm_model if user else "openai"
+    # Members, chat history and the preferred model in parallel
+    (members, chat_history), model_name = await asyncio.gather(load_room_ai_context(room_id), load_preferred_model(u.id))
     
-    members_res = await session.execute(
-        select(User.username)
-        .join(RoomMember, RoomMember.user_id == User.id)
-        .where(RoomMember.room_id == room_id)
-    )
-    members = [row[0] for row in members_res.fetchall()]
-    
-    # Get chat history
-    msgs_res = await session.execute(
-        select(Message)
-        .where(Message.room_id == room_id)
-        .order_by(Message.created_at) 
-    )
-    msgs = msgs_res.scalars().all()
-    
-    chat_history = []
-    for m in msgs:
-        role = "assistant" if m.is_bot else "user"
-        chat_history.append({"role": role, "content": m.content})
-        
     # Generate suggestion
-    suggestions = await suggest_invites(
-        members=members,
-        chat_history=chat_history,
-        goal=override_goal,
-        model_name=model_name,
-    )
+    async def run(on_token=None):
+        suggestions = await suggest_invites(
+            members=members,
+            chat_history=chat_history,
+            goal=override_goal,
+            model_name=model_name,
+            on_token=on_token,
+        )
+        return {"suggestions": suggestions}
     
-    return {"suggestions": suggestions}
\ No newline at end of file
+    if stream:
+        return StreamingResponse(stream_ai_result(run), media_type="text/event-stream")
+    key = ai_context_key("matching", room_id, model_name, override_goal, members, chat_history)
+    return await run_coalesced(key, run)
\ No newline at end of file
@@ -1,12 +1,18 @@
 import os
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import select
+from sqlalchemy.orm import load_only
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
+from db import User, get_db
+
 load_dotenv()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -16,6 +22,13 @@ JWT_SECRET = os.getenv("JWT_SECRET", "change_me")
 JWT_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES", "43200"))
 ALGORITHM = "HS256"
 
+# username -> (expires_at, User); lets authenticated endpoints skip the per-request user SELECT.
+# Per process: another worker/instance may keep serving a cached user for up to the TTL (e.g. after the
+# account is deleted), so only immutable columns are cached (no preferred_llm_model)
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = 10_000
+_user_cache: Dict[str, Tuple[float, User]] = {}
+
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password[:72])
 
@@ -30,7 +43,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 def get_current_user_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
-    token = credentials.credentials
+    return decode_access_token(credentials.credentials)
+
+def decode_access_token(token: str) -> str:
+    """Return the username (JWT subject) or raise 401"""
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -39,3 +55,32 @@ def get_current_user_token(credentials: HTTPAuthorizationCredentials = Depends(s
         return username
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+async def get_current_user(username: str = Depends(get_current_user_token), session: AsyncSession = Depends(get_db)) -> User:
+    """
+    Resolve the JWT subject to a User row.
+    Rows are cached for a short TTL; the returned instance is detached and must be treated as read-only.
+    Only id and username are loaded: read mutable columns (preferred_llm_model) from the DB where needed.
+    """
+    now = time.monotonic()
+    cached = _user_cache.get(username)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    # Immutable columns only; the password hash is never loaded into the cache
+    res = await session.execute(
+        select(User)
+        .options(load_only(User.id, User.username))
+        .where(User.username == username)
+    )
+    user = res.scalar_one_or_none()
+    if not user:
+        _user_cache.pop(username, None)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid user")
+
+    session.expunge(user)
+    if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+        _user_cache.clear()
+    _user_cache[username] = (now + USER_CACHE_TTL_SECONDS, user)
+    return user
+
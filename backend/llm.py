@@ -1,11 +1,25 @@
 import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Type
+
 import httpx
+import orjson
 import google.generativeai as genai
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from llm_modules.llm_utils import extract_json
 
 load_dotenv()
 
+logger = logging.getLogger("grocery.llm")
+
 # Supported models
 AVAILABLE_MODELS = {
     "openai": {
@@ -19,17 +33,195 @@ AVAILABLE_MODELS = {
     }
 }
 
+# Keys are read once at import; availability doesn't change at runtime
+GEMINI_AVAILABLE = bool(AVAILABLE_MODELS["gemini"]["api_key"])
+
 # Configure Gemini SDK if key provided
-if AVAILABLE_MODELS["gemini"]["api_key"]:
+if GEMINI_AVAILABLE:
     gemini_api_key = AVAILABLE_MODELS["gemini"]["api_key"]
     genai.configure(api_key=gemini_api_key)
 
 # Default model
 DEFAULT_MODEL = os.getenv("LLM_MODEL", "openai").strip().lower()
 
-async def chat_completion(messages, temperature: float = 0.2, max_tokens: int = 512, model_name: str = None) -> str:
+# Batch API jobs (offline, e.g. nightly restock analysis): polled every N seconds, abandoned after the completion window
+BATCH_POLL_INTERVAL_SECONDS = float(os.getenv("LLM_BATCH_POLL_INTERVAL_SECONDS", "30"))
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Reply cache: sha256(system prompt + model + normalized prompt) -> reply, LRU with TTL
+REPLY_CACHE_MAX_ENTRIES = 1024
+REPLY_CACHE_TTL_SECONDS = float(os.getenv("LLM_REPLY_CACHE_TTL_SECONDS", "3600"))
+_reply_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+def reply_cache_key(system_prompt: str, model_name: str, prompt: str) -> str:
+    normalized = " ".join(prompt.lower().split())
+    raw = "\x1f".join([system_prompt, model_name or "", normalized])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def get_cached_reply(key: str) -> Optional[str]:
+    entry = _reply_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, reply = entry
+    if expires_at < time.monotonic():
+        del _reply_cache[key]
+        return None
+    _reply_cache.move_to_end(key)
+    return reply
+
+def set_cached_reply(key: str, reply: str) -> None:
+    _reply_cache[key] = (time.monotonic() + REPLY_CACHE_TTL_SECONDS, reply)
+    _reply_cache.move_to_end(key)
+    while len(_reply_cache) > REPLY_CACHE_MAX_ENTRIES:
+        _reply_cache.popitem(last=False)
+
+# One pooled client for all provider calls, so repeat requests reuse the TCP/TLS connection.
+# HTTP/2 (multiplexing concurrent calls on one connection) needs the optional h2 package.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=120.0,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    global _http_client, _openai_client
+    _openai_client = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# OpenAI SDK client (embeddings, Batch API) on top of the same pooled connection
+_openai_client: Optional[AsyncOpenAI] = None
+_openai_http_client: Optional[httpx.AsyncClient] = None
+
+def get_openai_client() -> AsyncOpenAI:
+    global _openai_client, _openai_http_client
+    http_client = get_http_client()
+    if _openai_client is None or _openai_http_client is not http_client:
+        _openai_client = AsyncOpenAI(api_key=AVAILABLE_MODELS["openai"]["api_key"] or None, http_client=http_client)
+        _openai_http_client = http_client
+    return _openai_client
+
+# Completion cache: identical requests (same messages, model and sampling settings) reuse the reply.
+# Backed by the in-process LRU above, plus Redis (shared by all workers) when REDIS_URL is set.
+COMPLETION_CACHE_PREFIX = "llm:completion:"
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+_cache_redis = None
+
+def completion_cache_key(messages, model_name: str, temperature: float, max_tokens: int, schema: Optional[Type[BaseModel]] = None) -> str:
+    raw = json.dumps([messages, model_name, temperature, max_tokens, schema.__name__ if schema else None], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _get_cache_redis():
+    global _cache_redis
+    if _cache_redis is None and REDIS_URL:
+        import redis.asyncio as redis
+        _cache_redis = redis.from_url(REDIS_URL, decode_responses=True)
+    return _cache_redis
+
+async def close_completion_cache() -> None:
+    global _cache_redis
+    if _cache_redis is not None:
+        await _cache_redis.aclose()
+        _cache_redis = None
+
+async def _get_cached_completion(key: str) -> Optional[str]:
+    reply = get_cached_reply(key)
+    if reply is not None:
+        return reply
+    client = _get_cache_redis()
+    if client is None:
+        return None
+    try:
+        reply = await client.get(COMPLETION_CACHE_PREFIX + key)
+    except Exception:
+        logger.warning("Completion cache read failed", exc_info=True)
+        return None
+    if reply is not None:
+        set_cached_reply(key, reply)
+    return reply
+
+async def _set_cached_completion(key: str, reply: str) -> None:
+    set_cached_reply(key, reply)
+    client = _get_cache_redis()
+    if client is None:
+        return
+    try:
+        await client.set(COMPLETION_CACHE_PREFIX + key, reply, ex=int(REPLY_CACHE_TTL_SECONDS))
+    except Exception:
+        logger.warning("Completion cache write failed", exc_info=True)
+
+def _is_cacheable(reply: str, schema: Optional[Type[BaseModel]]) -> bool:
+    """Only complete replies are cached: never an empty one, and for schema calls only JSON that extract_json can read"""
+    if not reply or not reply.strip():
+        return False
+    return schema is None or bool(extract_json(reply))
+
+def openai_response_format(schema: Type[BaseModel]) -> dict:
+    """
+    Structured Outputs: the model can only emit JSON matching the schema.
+    Strict mode needs every field required and no extra keys (see llm_utils.LLMSchema).
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema(), "strict": True},
+    }
+
+def prompt_cache_key(messages) -> Optional[str]:
+    """
+    OpenAI routes requests with the same prompt_cache_key to the same prefix cache.
+    Keyed by the system prompt: every call of one module shares its (static) prefix.
+    """
+    if messages and messages[0].get("role") == "system":
+        return hashlib.sha256(messages[0]["content"].encode("utf-8")).hexdigest()[:32]
+    return None
+
+def _generation_config(temperature: float, max_tokens: int, schema: Optional[Type[BaseModel]]):
+    # Gemini's response_schema takes a narrower OpenAPI subset; JSON mode alone guarantees parseable output
+    return genai.types.GenerationConfig(
+        temperature=temperature,
+        max_output_tokens=max_tokens,
+        response_mime_type="application/json" if schema else None,
+    )
+
+# Placeholder reply when Gemini's safety filters block the whole response (never cached)
+GEMINI_FILTERED_REPLY = "[Response was filtered by Gemini safety policies]"
+
+def _to_gemini_messages(messages):
+    """
+    Convert OpenAI-style messages to Gemini format
+    Gemini expects [{"role": "user"/"model", "parts": [{"text": "..."}]}]
+    """
+    gemini_messages = []
+    for m in messages:
+        role = m.get("role", "user")
+        content_text = m.get("content", "")
+        # Convert role: "assistant" -> "model", others stay as "user"
+        gemini_role = "model" if role == "assistant" else "user"
+        gemini_messages.append({
+            "role": gemini_role,
+            "parts": [{"text": content_text}]
+        })
+    return gemini_messages
+
+async def chat_completion(messages, temperature: float = 0.2, max_tokens: int = 512, model_name: str = None, use_cache: bool = True, schema: Optional[Type[BaseModel]] = None) -> str:
     """
     Supports multiple models: openai, gemini
+    Identical requests are answered from the completion cache unless use_cache is False.
+    With a schema the reply is constrained to JSON matching it (OpenAI Structured Outputs / Gemini JSON mode).
     """
     if model_name is None:
         model_name = DEFAULT_MODEL
@@ -37,6 +229,22 @@ async def chat_completion(messages, temperature: float = 0.2, max_tokens: int =
     if model_name not in AVAILABLE_MODELS:
         raise ValueError(f"Model '{model_name}' not available. Choose from: {list(AVAILABLE_MODELS.keys())}")
     
+    if not use_cache:
+        reply, _ = await _chat_completion(messages, temperature, max_tokens, model_name, schema)
+        return reply
+    
+    key = completion_cache_key(messages, model_name, temperature, max_tokens, schema)
+    reply = await _get_cached_completion(key)
+    if reply is None:
+        reply, complete = await _chat_completion(messages, temperature, max_tokens, model_name, schema)
+        # A filtered, empty or unreadable reply may be transient: don't pin it for every worker
+        if complete and _is_cacheable(reply, schema):
+            await _set_cached_completion(key, reply)
+    return reply
+
+
+async def _chat_completion(messages, temperature: float, max_tokens: int, model_name: str, schema: Optional[Type[BaseModel]] = None) -> Tuple[str, bool]:
+    """(reply text, complete): complete is False when the provider blocked the reply and a placeholder is returned"""
     config = AVAILABLE_MODELS[model_name]
     provider = model_name
 
@@ -54,43 +262,33 @@ async def chat_completion(messages, temperature: float = 0.2, max_tokens: int =
             "max_tokens": max_tokens,
             "stream": False
         }
+        if schema is not None:
+            payload["response_format"] = openai_response_format(schema)
+        cache_key = prompt_cache_key(messages)
+        if cache_key:
+            payload["prompt_cache_key"] = cache_key
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            r = await client.post(url, headers=headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
-            return data["choices"][0]["message"]["content"]
+        r = await get_http_client().post(url, headers=headers, json=payload)
+        r.raise_for_status()
+        data = r.json()
+        return data["choices"][0]["message"]["content"], True
 
     elif provider == "gemini":
         # Google Generative AI SDK (official)
         model = genai.GenerativeModel(config["model"])
         
-        # Convert OpenAI-style messages to Gemini format
-        # Gemini expects [{"role": "user"/"model", "parts": [{"text": "..."}]}]
-        gemini_messages = []
-        for m in messages:
-            role = m.get("role", "user")
-            content_text = m.get("content", "")
-            # Convert role: "assistant" -> "model", others stay as "user"
-            gemini_role = "model" if role == "assistant" else "user"
-            gemini_messages.append({
-                "role": gemini_role,
-                "parts": [{"text": content_text}]
-            })
+        gemini_messages = _to_gemini_messages(messages)
         
-        # Use generate_content with permissive settings
-        response = model.generate_content(
+        # Async SDK call so the event loop keeps serving other requests while Gemini generates
+        response = await model.generate_content_async(
             gemini_messages,
-            generation_config=genai.types.GenerationConfig(
-                temperature=temperature,
-                max_output_tokens=max_tokens
-            )
+            generation_config=_generation_config(temperature, max_tokens, schema)
         )
         
         # Handle blocked responses gracefully
         try:
             if response.text:
-                return response.text
+                return response.text, True
         except ValueError:
             pass
         
@@ -99,19 +297,179 @@ async def chat_completion(messages, temperature: float = 0.2, max_tokens: int =
             candidate = response.candidates[0]
             if hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts'):
                 if len(candidate.content.parts) > 0:
-                    return candidate.content.parts[0].text
+                    return candidate.content.parts[0].text, True
         
-        return "[Response was filtered by Gemini safety policies]"
+        return GEMINI_FILTERED_REPLY, False
 
     else:
         # If reached here, unsupported provider
         raise ValueError(f"Unsupported provider: {provider}")
 
 
+async def chat_completion_stream(messages, temperature: float = 0.2, max_tokens: int = 512, model_name: str = None, schema: Optional[Type[BaseModel]] = None):
+    """
+    Streaming variant of chat_completion: yields text deltas as the provider produces them.
+    """
+    if model_name is None:
+        model_name = DEFAULT_MODEL
+    
+    if model_name not in AVAILABLE_MODELS:
+        raise ValueError(f"Model '{model_name}' not available. Choose from: {list(AVAILABLE_MODELS.keys())}")
+    
+    config = AVAILABLE_MODELS[model_name]
+    provider = model_name
+
+    if provider == "openai":
+        url = f"{config['api_base']}/chat/completions"
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {config['api_key']}"
+        }
+        payload = {
+            "model": config["model"],
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+        if schema is not None:
+            payload["response_format"] = openai_response_format(schema)
+        cache_key = prompt_cache_key(messages)
+        if cache_key:
+            payload["prompt_cache_key"] = cache_key
+        
+        async with get_http_client().stream("POST", url, headers=headers, json=payload) as r:
+            r.raise_for_status()
+            # Server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices") or []
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+
+    elif provider == "gemini":
+        model = genai.GenerativeModel(config["model"])
+        response = await model.generate_content_async(
+            _to_gemini_messages(messages),
+            generation_config=_generation_config(temperature, max_tokens, schema),
+            stream=True,
+        )
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk was blocked by safety filters
+                continue
+            if text:
+                yield text
+
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+
+async def chat_completion_text(messages, temperature: float = 0.2, max_tokens: int = 512, model_name: str = None, on_token=None, schema: Optional[Type[BaseModel]] = None) -> str:
+    """
+    chat_completion, or chat_completion_stream when on_token is given:
+    each delta is awaited through on_token as it arrives and the joined text is returned.
+    Both paths share the completion cache; a cached reply is delivered as a single token.
+    """
+    if on_token is None:
+        return await chat_completion(messages, temperature=temperature, max_tokens=max_tokens, model_name=model_name, schema=schema)
+    key = completion_cache_key(messages, model_name or DEFAULT_MODEL, temperature, max_tokens, schema)
+    cached = await _get_cached_completion(key)
+    if cached is not None:
+        await on_token(cached)
+        return cached
+    parts = []
+    async for delta in chat_completion_stream(messages, temperature=temperature, max_tokens=max_tokens, model_name=model_name, schema=schema):
+        parts.append(delta)
+        await on_token(delta)
+    reply = "".join(parts)
+    if _is_cacheable(reply, schema):
+        await _set_cached_completion(key, reply)
+    return reply
+
+
 async def get_embedding(text, model="text-embedding-3-large"):
-    client = AsyncOpenAI()
+    client = get_openai_client()
     res = await client.embeddings.create(
         model=model,
         input=text,
     )
-    return res.data[0].embedding
\ No newline at end of file
+    return res.data[0].embedding
+
+async def get_embeddings_batch(texts: List[str], model="text-embedding-3-large") -> List[List[float]]:
+    """One embeddings request for many inputs (the API takes up to 2048); vectors come back in input order."""
+    client = get_openai_client()
+    res = await client.embeddings.create(
+        model=model,
+        input=texts,
+    )
+    return [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+
+
+async def submit_batch(requests: List[dict], temperature: float = 0.2, max_tokens: int = 512, model_name: str = None, schema: Optional[Type[BaseModel]] = None) -> Dict[str, str]:
+    """
+    Run many chat completions through the OpenAI Batch API (half the price, results within 24h).
+    requests: [{"custom_id": str, "messages": [...]}]. Returns custom_id -> reply text;
+    requests that failed inside the batch are left out. Meant for offline jobs, not request handlers.
+    """
+    if model_name is None:
+        model_name = DEFAULT_MODEL
+    if model_name != "openai":
+        raise ValueError(f"Batch API is only supported for openai, not '{model_name}'")
+    if not requests:
+        return {}
+
+    config = AVAILABLE_MODELS[model_name]
+    lines = [
+        json.dumps({
+            "custom_id": req["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": config["model"],
+                "messages": req["messages"],
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                **({"response_format": openai_response_format(schema)} if schema is not None else {}),
+            },
+        })
+        for req in requests
+    ]
+
+    client = get_openai_client()
+    batch_file = await client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=BATCH_COMPLETION_WINDOW,
+    )
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+
+    if not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}' and no output")
+
+    output = await client.files.content(batch.output_file_id)
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
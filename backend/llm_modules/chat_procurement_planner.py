@@ -1,19 +1,22 @@
-import json
+import orjson
 from typing import List, Dict, Any
 
-from llm_modules.llm_utils import (extract_goal, extract_json, format_chat_history,)
+from llm_modules.llm_utils import (LLMSchema, extract_json, format_chat_history,)
 from llm import chat_completion
 
-async def generate_procurement_plan(chat_history: List[Dict[str, str]], model_name: str = "openai",) -> Dict[str, Any]:
-    """
-    Chat-based procurement planner
-    Generates a consolidated shopping list by analyzing user intent, resolving conflicts, and merging quantities.
-    """
-    
-    inferred_goal = await extract_goal(chat_history, model_name=model_name)
-    chat_text = format_chat_history(chat_history)
-    
-    system_prompt = """
+class ProcurementItem(LLMSchema):
+    name: str
+    quantity: str
+    category: str
+    notes: str
+
+class ProcurementPlan(LLMSchema):
+    goal: str
+    summary: str
+    narrative: str
+    items: List[ProcurementItem]
+
+PROCUREMENT_PLAN_SYSTEM_PROMPT = """
     You are an intelligent AI Procurement Planner.
     
     Your goal is to create a consolidated shopping list based on the chat history.
@@ -26,7 +29,7 @@ async def generate_procurement_plan(chat_history: List[Dict[str, str]], model_na
 
     OUTPUT FORMAT (STRICT JSON ONLY):
     {
-        "goal": "<string (The extracted event or goal)>",
+        "goal": "<string (The event or goal inferred from the chat history)>",
         "summary": "<string (A brief 1-sentence summary of the plan)>",
         "narrative": "<string (A friendly, human-like explanation of what was decided)>",
         "items": [
@@ -44,27 +47,30 @@ async def generate_procurement_plan(chat_history: List[Dict[str, str]], model_na
     - Do NOT include markdown formatting like ```json ... ```.
     """
 
+async def generate_procurement_plan(chat_history: List[Dict[str, str]], model_name: str = "openai",) -> Dict[str, Any]:
+    """
+    Chat-based procurement planner
+    Generates a consolidated shopping list by analyzing user intent, resolving conflicts, and merging quantities.
+    """
     
-    user_content = json.dumps(
-        {
-            "inferred_goal": inferred_goal,
-            "chat_history_text": chat_text,
-        },
-        indent=2
-    )
+    # The goal is inferred in the same call (the "goal" field below) instead of a separate LLM round-trip
+    chat_text = format_chat_history(chat_history)
+    
+    user_content = orjson.dumps({"chat_history_text": chat_text}).decode()
     
     raw = await chat_completion(
         [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": PROCUREMENT_PLAN_SYSTEM_PROMPT},
             {"role": "user", "content": user_content},
         ],
         model_name=model_name,
+        schema=ProcurementPlan,
     )
 
     data = extract_json(raw)
     
     return {
-        "goal": data.get("goal", inferred_goal),
+        "goal": data.get("goal", ""),
         "summary": data.get("summary", "Shopping list generated."),
         "narrative": data.get("narrative", "Here is your consolidated shopping plan."),
         "items": data.get("items", []),
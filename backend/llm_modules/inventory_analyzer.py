@@ -1,18 +1,15 @@
-import json
+import orjson
 from typing import List, Dict, Any
 
-from llm import chat_completion
-from llm_modules.llm_utils import format_chat_history, extract_json
+from llm import chat_completion, submit_batch
+from llm_modules.llm_utils import LLMSchema, InventoryLine, format_chat_history, extract_json
 
-async def analyze_inventory(inventory_items, low_stock_items, healthy_items, grocery_items, chat_history: List[Dict[str, str]] | None = None, model_name: str = "openai") -> Dict[str, Any]:
-    """
-    LLM Inventory Analyzer
-    Analyze current inventory and generate restock suggestions using Vector Search results.
-    """
-    
-    chat_text = format_chat_history(chat_history) if chat_history else ""
-    
-    system_prompt = """
+class InventoryAnalysisResult(LLMSchema):
+    narrative: str
+    low_stock: List[InventoryLine]
+    healthy: List[InventoryLine]
+
+INVENTORY_ANALYSIS_SYSTEM_PROMPT = """
     You are an Inventory Analyst.
 
     INPUT DATA EXPLANATION:
@@ -36,6 +33,9 @@ async def analyze_inventory(inventory_items, low_stock_items, healthy_items, gro
     - Do NOT change the stock numbers.
     - JSON ONLY.
     """
+
+def _build_analysis_messages(inventory_items, low_stock_items, healthy_items, grocery_items, chat_history: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
+    chat_text = format_chat_history(chat_history) if chat_history else ""
     
     user_payload = {
         "inventory_items": inventory_items,
@@ -45,11 +45,12 @@ async def analyze_inventory(inventory_items, low_stock_items, healthy_items, gro
         "chat_history": chat_text
     }
     
-    raw = await chat_completion([
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(user_payload, indent=2)},
-    ], model_name=model_name)
-    
+    return [
+        {"role": "system", "content": INVENTORY_ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": orjson.dumps(user_payload, default=str).decode()},
+    ]
+
+def _parse_analysis(raw: str, low_stock_items, healthy_items) -> Dict[str, Any]:
     parsed = extract_json(raw)
     
     # Add helpful CTA
@@ -61,4 +62,38 @@ async def analyze_inventory(inventory_items, low_stock_items, healthy_items, gro
         "narrative": final_narrative,
         "low_stock": parsed.get("low_stock", low_stock_items),
         "healthy": parsed.get("healthy", healthy_items),
-    }
\ No newline at end of file
+    }
+
+async def analyze_inventory(inventory_items, low_stock_items, healthy_items, grocery_items, chat_history: List[Dict[str, str]] | None = None, model_name: str = "openai") -> Dict[str, Any]:
+    """
+    LLM Inventory Analyzer
+    Analyze current inventory and generate restock suggestions using Vector Search results.
+    """
+    messages = _build_analysis_messages(inventory_items, low_stock_items, healthy_items, grocery_items, chat_history)
+    raw = await chat_completion(messages, model_name=model_name, schema=InventoryAnalysisResult)
+    return _parse_analysis(raw, low_stock_items, healthy_items)
+
+async def analyze_inventory_bulk(jobs: List[Dict[str, Any]], model_name: str = "openai") -> List[Dict[str, Any]]:
+    """
+    Offline variant of analyze_inventory for many inventories at once (e.g. a nightly restock run).
+    Each job holds analyze_inventory's arguments by name; all of them go through one Batch API job.
+    Results come back in job order; a job the batch failed on gets the default narrative.
+    """
+    requests = [
+        {
+            "custom_id": str(i),
+            "messages": _build_analysis_messages(
+                job["inventory_items"],
+                job["low_stock_items"],
+                job["healthy_items"],
+                job["grocery_items"],
+                job.get("chat_history"),
+            ),
+        }
+        for i, job in enumerate(jobs)
+    ]
+    replies = await submit_batch(requests, model_name=model_name, schema=InventoryAnalysisResult)
+    return [
+        _parse_analysis(replies.get(str(i), ""), job["low_stock_items"], job["healthy_items"])
+        for i, job in enumerate(jobs)
+    ]
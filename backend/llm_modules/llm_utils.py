@@ -1,25 +1,89 @@
-import json
 import re
 from typing import List, Dict, Any
 
-from llm import chat_completion
+import ijson
+import orjson
+from json_repair import repair_json
+from pydantic import BaseModel, ConfigDict
+
+# Token counting for prompt budgets: tiktoken when installed, else the ~4 characters/token rule of thumb
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def trim_history_to_token_budget(chat_history: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+    """
+    Keep the most recent messages whose combined content fits in max_tokens (oldest dropped first).
+    The newest message is always kept, even if it alone exceeds the budget.
+    """
+    kept = []
+    total = 0
+    for m in reversed(chat_history):
+        total += count_tokens(m["content"])
+        if total > max_tokens and kept:
+            break
+        kept.append(m)
+    kept.reverse()
+    return kept
+
+class LLMSchema(BaseModel):
+    """
+    Base for reply schemas passed to chat_completion(schema=...).
+    Extra keys are forbidden and fields get no defaults, as OpenAI strict Structured Outputs require.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+class InventoryLine(LLMSchema):
+    product_name: str
+    stock: int
+    safety_stock_level: int
 
 def format_chat_history(chat_history: List[Dict[str, str]]) -> str:
-    lines = []
-    for m in chat_history:
-        role = "User" if m["role"] == "user" else "Assistant"
-        content = m["content"].replace("\n", " ")
-        lines.append(f"[{role}] {content}")
-    return "\n".join(lines)
+    return "\n".join(
+        ("[User] " if m["role"] == "user" else "[Assistant] ") + m["content"].replace("\n", " ")
+        for m in chat_history
+    )
+
+def json_item_feeder(prefix: str, on_item):
+    """
+    on_token callback for chat_completion_text that feeds the streamed reply into an incremental
+    JSON parser: on_item is awaited with each element under prefix (e.g. "dishes.item") as soon as it is complete.
+    Output that is not plain JSON (markdown fences, ...) just yields nothing; the final extract_json still handles it.
+    """
+    items = ijson.sendable_list()
+    parser = ijson.items_coro(items, prefix, use_float=True)
+    broken = False
+
+    async def feed(delta: str):
+        nonlocal broken
+        if broken:
+            return
+        try:
+            parser.send(delta.encode("utf-8"))
+        except ijson.JSONError:
+            broken = True
+        for item in items:
+            await on_item(item)
+        del items[:]
+
+    return feed
 
 def extract_json(text: str) -> Dict[str, Any]:
     """
     Production-grade LLM JSON extractor.
-    Handles:
+    Fast path: the reply is already valid JSON (orjson).
+    Otherwise one json_repair pass handles:
     - ```json fenced blocks
-    - raw JSON inside text
     - extra commentary before/after JSON
-    - nested braces
+    - trailing commas, unquoted keys, braces inside strings
+    - replies truncated mid-object
     - Gemini/Claude/OpenAI mixed output
     
     Returns empty dict if parsing fails.
@@ -28,50 +92,20 @@ def extract_json(text: str) -> Dict[str, Any]:
     if not text or not isinstance(text, str):
         return {}
 
-    # 1) Try direct parse
     try:
-        return json.loads(text)
-    except Exception:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         pass
 
-    # 2) Try to extract fenced code block ```json ... ```
-    fenced = re.findall(r"```(?:json)?(.*?)```", text, re.DOTALL | re.IGNORECASE)
-    for block in fenced:
-        block = block.strip()
-        try:
-            return json.loads(block)
-        except Exception:
-            continue
-
-    # 3) Find the first { and last } and try to parse the substring
-    start = text.find("{")
-    end = text.rfind("}")
-    if 0 <= start < end:
-        snippet = text[start : end + 1]
-        try:
-            return json.loads(snippet)
-        except Exception:
-            pass
-
-    # 4) Try to recover partial JSON using regex (matches balanced {...})
-    json_candidates = re.findall(r"\{(?:[^{}]|(?:\{.*\}))*\}", text, re.DOTALL)
-    for candidate in json_candidates:
-        try:
-            return json.loads(candidate)
-        except Exception:
-            continue
-
-    # 5) Last-ditch: fix common errors like trailing commas
     try:
-        cleaned = re.sub(r",\s*}", "}", text)
-        cleaned = re.sub(r",\s*]", "]", cleaned)
-        start = cleaned.find("{")
-        end = cleaned.rfind("}") + 1
-        if start != -1 and end != -1:
-            return json.loads(cleaned[start:end])
+        repaired = repair_json(text, return_objects=True)
     except Exception:
-        pass
-
+        return {}
+    if isinstance(repaired, dict):
+        return repaired
+    if isinstance(repaired, list):
+        # Commentary around the object can come back as a list of fragments: take the first object
+        return next((item for item in repaired if isinstance(item, dict)), {})
     return {}
 
 def ensure_narrative(data: Dict[str, Any], default: str) -> Dict[str, Any]:
@@ -86,84 +120,23 @@ def ensure_narrative(data: Dict[str, Any], default: str) -> Dict[str, Any]:
         data["narrative"] = default
     return data
 
-async def extract_goal(chat_history: List[Dict[str, str]], model_name: str = "openai",) -> str:
-    """
-    Extract the event goal from chat history using LLM.
-    If none found, returns "".
-    """
-    chat_text = format_chat_history(chat_history)
-    
-    system_prompt = """
-    You are an AI assistant. Identify the main event goal of the group based on the chat history.
-    
-    The goal could be things like:
-    - "BBQ party this Saturday"
-    - "Friendsgiving dinner"
-    - "Weekly grocery shopping"
-    - "Hotpot night with friends"
-    - "Prepare next week's menu and restock"
-    
-    Output JSON ONLY:
-    {
-        "goal": "<string>"
-    }
-    
-    If there is no clear goal, return:
-    {
-        "goal": ""
-    }
-    """
-    
-    user_prompt = f"Chat history:\n{chat_text}\n\nExtract the goal in JSON."
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-    
-    raw = await chat_completion(messages, model_name=model_name)
-    data = extract_json(raw)
-    return data.get("goal", "")
-
-async def extract_assigned_members(chat_history: List[Dict[str, str]], members: List[str], model_name: str = "openai",) -> List[str]:
-    """
-    Let LLM decide which members from the list have been assigned tasks based on the chat history.
-    Only names present in `members` will be kept.
+def extract_assigned_members(chat_history: List[Dict[str, str]], members: List[str]) -> List[str]:
     """
-    chat_text = format_chat_history(chat_history)
-    
-    system_prompt = """
-    You detect which members from the given list have been assigned tasks based on the chat history.
-    
-    Output JSON ONLY:
-    {
-        "assigned": ["name1", "name2"]
-    }
-    
-    Rules:
-    - Only include names that appear in the provided member list.
-    - If nobody is clearly assigned, return an empty list.
+    Members from the list whose name is mentioned in the chat history (case-insensitive, whole words).
+    One regex pass over the joined messages; returned in `members` order.
     """
-    
-    user_prompt = f"""
-    Chat history:
-    {chat_text}
-    
-    Member list: {", ".join(members)}
-    """
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-    
-    raw = await chat_completion(messages, model_name=model_name)
-    data = extract_json(raw)
-    
-    assigned = data.get("assigned", [])
-    # Make sure returning the name in members
-    return [m for m in assigned if m in members]
+    if not members or not chat_history:
+        return []
+    # casefold, not lower: IGNORECASE also matches characters lower() doesn't map back (e.g. "ſam" for "Sam")
+    by_folded = {m.casefold(): m for m in members}
+    # Longest names first so "Ann Lee" wins over "Ann" at the same position
+    names = sorted(members, key=len, reverse=True)
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, names)) + r")(?!\w)", re.IGNORECASE)
+    text = "\n".join(m["content"] for m in chat_history)
+    mentioned = {by_folded.get(match.casefold()) for match in pattern.findall(text)}
+    return [m for m in members if m in mentioned]
 
 def get_available_members(members: List[str], assigned: List[str]) -> List[str]:
     # Return members who are not yet assigned.
-    return [m for m in members if m not in assigned]
\ No newline at end of file
+    assigned_set = frozenset(assigned)
+    return [m for m in members if m not in assigned_set]
\ No newline at end of file
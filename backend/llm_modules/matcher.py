@@ -1,30 +1,21 @@
-import json
-from typing import List, Dict, Any
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
-from llm import chat_completion
+from llm import chat_completion_text
 from llm_modules.llm_utils import (
+    LLMSchema,
     format_chat_history,
     extract_json,
-    extract_goal,
     extract_assigned_members,
     get_available_members,
 )
 
 
-async def suggest_invites(
-    members: List[str],
-    chat_history: List[Dict[str, str]],
-    goal: str | None = None,
-    model_name: str = "openai"
-) -> Dict[str, Any]:
-
-    if not goal:
-        goal = await extract_goal(chat_history, model_name=model_name)
-
-    assigned = await extract_assigned_members(chat_history, members, model_name=model_name)
-    available = get_available_members(members, assigned)
+class MatchingSuggestion(LLMSchema):
+    suggested_invites: List[str]
+    missing_roles: List[str]
+    narrative: str
 
-    system_prompt = """
+MATCHING_SYSTEM_PROMPT = """
     You are an AI assistant helping a group plan an event.
 
     STRICT RULES:
@@ -43,12 +34,24 @@ async def suggest_invites(
     - "suggested_invites" MUST be chosen from the available member list.
     - If additional help is needed beyond available members, place type descriptions into "missing_roles".
     - "narrative" should be friendly and casual.
+    - If no goal is given, infer it from the chat history.
     """
 
+async def suggest_invites(
+    members: List[str],
+    chat_history: List[Dict[str, str]],
+    goal: str | None = None,
+    model_name: str = "openai",
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> Dict[str, Any]:
+
+    assigned = extract_assigned_members(chat_history, members)
+    available = get_available_members(members, assigned)
+
     chat_text = format_chat_history(chat_history)
 
     user_prompt = f"""
-    Goal: {goal}
+    Goal: {goal or "(not given, infer it from the chat history)"}
 
     All members: {', '.join(members)}
     Assigned members: {', '.join(assigned) if assigned else 'None'}
@@ -60,12 +63,14 @@ async def suggest_invites(
     Generate the JSON suggestion now.
     """
 
-    raw = await chat_completion(
+    raw = await chat_completion_text(
         [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": MATCHING_SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
         model_name=model_name,
+        on_token=on_token,
+        schema=MatchingSuggestion,
     )
 
     data = extract_json(raw)
@@ -1,20 +1,26 @@
-import json
-from typing import List, Dict, Any
+import orjson
+from typing import List, Dict, Any, Awaitable, Callable, Optional
 
-from llm import chat_completion
-from llm_modules.llm_utils import extract_json, format_chat_history
+from llm import chat_completion_text
+from llm_modules.llm_utils import LLMSchema, extract_json, format_chat_history, json_item_feeder
 
 
-async def generate_menu(inventory_items, grocery_items, chat_history: List[Dict[str, str]] | None = None, model_name: str = "openai") -> Dict[str, Any]:
-    """
-    Generate recommended dishes based on:
-    - User inventory (Curreent Stock)
-    - Grocery_items catalog (Vector Search Results containing Real Products)
-    - Chat context
-    """
-    chat_text = format_chat_history(chat_history) if chat_history else ""
-    
-    system_prompt = """
+class SupplierSuggestion(LLMSchema):
+    product_name: str
+    price: float
+    reason: str
+
+class Dish(LLMSchema):
+    name: str
+    ingredients_used: List[str]
+    missing_ingredients: List[str]
+    suggested_suppliers_needed: List[SupplierSuggestion]
+
+class MenuPlan(LLMSchema):
+    narrative: str
+    dishes: List[Dish]
+
+MENU_SYSTEM_PROMPT = """
     You are an AI Executive Chef for a restaurant.
     
     INPUT DATA:
@@ -57,6 +63,16 @@ async def generate_menu(inventory_items, grocery_items, chat_history: List[Dict[
     - Do NOT hallucinate products. Only use products present in "grocery_items" for the suggested_suppliers_needed field.
     - If a missing ingredient is simple (like "Salt" or "Water") and not in the list, just ignore it in supplier list.
     """
+
+async def generate_menu(inventory_items, grocery_items, chat_history: List[Dict[str, str]] | None = None, model_name: str = "openai", on_dish: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> Dict[str, Any]:
+    """
+    Generate recommended dishes based on:
+    - User inventory (Curreent Stock)
+    - Grocery_items catalog (Vector Search Results containing Real Products)
+    - Chat context
+    If on_dish is given, the reply is streamed and each dish is passed to it as soon as it is complete.
+    """
+    chat_text = format_chat_history(chat_history) if chat_history else ""
     
     user_payload = {
         "inventory_items": inventory_items,
@@ -65,12 +81,14 @@ async def generate_menu(inventory_items, grocery_items, chat_history: List[Dict[
     }
     
     
-    raw = await chat_completion(
+    raw = await chat_completion_text(
         [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": json.dumps(user_payload, indent=2)},
+            {"role": "system", "content": MENU_SYSTEM_PROMPT},
+            {"role": "user", "content": orjson.dumps(user_payload, default=str).decode()},
         ],
         model_name=model_name,
+        on_token=json_item_feeder("dishes.item", on_dish) if on_dish else None,
+        schema=MenuPlan,
     )
     
     parsed = extract_json(raw)
@@ -1,30 +1,25 @@
-import json
-from typing import List, Dict, Any
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
-from llm import chat_completion
+from llm import chat_completion_text
 from llm_modules.llm_utils import (
+    LLMSchema,
     format_chat_history,
     extract_json,
-    extract_goal,
 )
 
 
-async def generate_group_plan(
-    chat_history: List[Dict[str, str]],
-    goal: str | None = None,
-    members: List[str] | None = None,
-    model_name: str = "openai"
-) -> Dict[str, Any]:
-    """
-    Generate a structured group plan based on chat context.
-    """
+class PlanItem(LLMSchema):
+    name: str
+    assigned_to: str
 
-    if not goal:
-        goal = await extract_goal(chat_history, model_name=model_name)
+class GroupPlan(LLMSchema):
+    event: str
+    summary: str
+    items: List[PlanItem]
+    timeline: List[str]
+    narrative: str
 
-    members = members or []
-
-    system_prompt = """
+GROUP_PLAN_SYSTEM_PROMPT = """
     You are an AI assistant generating a structured group plan.
 
     STRICT RULES:
@@ -51,13 +46,28 @@ async def generate_group_plan(
     - "items" MUST be an array.
     - Make narrative friendly.
     - Use ONLY member names provided (no new people).
+    - If no goal is given, infer it from the chat history and use it as "event".
     """
 
+async def generate_group_plan(
+    chat_history: List[Dict[str, str]],
+    goal: str | None = None,
+    members: List[str] | None = None,
+    model_name: str = "openai",
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> Dict[str, Any]:
+    """
+    Generate a structured group plan based on chat context.
+    If on_token is given, the raw model output is streamed through it while generating.
+    """
+
+    members = members or []
+
     chat_text = format_chat_history(chat_history)
     members_list = ", ".join(members) if members else "None"
 
     user_prompt = f"""
-    Goal: {goal}
+    Goal: {goal or "(not given, infer it from the chat history)"}
     Members: {members_list}
 
     Chat history:
@@ -66,18 +76,20 @@ async def generate_group_plan(
     Generate JSON with all required keys.
     """
 
-    raw = await chat_completion(
+    raw = await chat_completion_text(
         [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": GROUP_PLAN_SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
         model_name=model_name,
+        on_token=on_token,
+        schema=GroupPlan,
     )
 
     data = extract_json(raw)
 
     # Fallback + normalization
-    event = data.get("event", goal or "")
+    event = data.get("event") or goal or ""
     summary = data.get("summary", "Here is your group plan.")
     items = data.get("items", [])
     timeline = data.get("timeline", [])
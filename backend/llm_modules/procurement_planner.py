@@ -1,17 +1,24 @@
-import json
+import orjson
 from typing import List, Dict, Any
 
 from llm import chat_completion
-from llm_modules.llm_utils import extract_json
+from llm_modules.llm_utils import LLMSchema, InventoryLine, extract_json
 
 
-async def generate_restock_plan(low_stock_items, grocery_items, model_name:str = "openai"):
-    """
-    Inventory-based retock
-    Generate AI-powered weekly restock plan using inventory + vector search matches.
-    """
-    
-    system_prompt = """
+class RestockItem(LLMSchema):
+    name: str
+    quantity: int
+    price_estimate: float
+    notes: str
+
+class RestockPlan(LLMSchema):
+    goal: str
+    summary: str
+    narrative: str
+    items: List[RestockItem]
+    low_stock: List[InventoryLine]
+
+RESTOCK_PLAN_SYSTEM_PROMPT = """
     You are an AI Procurement Planner for a restaurant.
 
     INPUT DATA:
@@ -46,7 +53,12 @@ async def generate_restock_plan(low_stock_items, grocery_items, model_name:str =
     - If no clear match is found in grocery_items, you may estimate, but note it.
     - JSON ONLY.
     """
-    
+
+async def generate_restock_plan(low_stock_items, grocery_items, model_name:str = "openai"):
+    """
+    Inventory-based retock
+    Generate AI-powered weekly restock plan using inventory + vector search matches.
+    """
     
     user_payload = {
         "low_stock": low_stock_items,
@@ -55,10 +67,11 @@ async def generate_restock_plan(low_stock_items, grocery_items, model_name:str =
     
     raw = await chat_completion(
         [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": json.dumps(user_payload, indent=2)}
+            {"role": "system", "content": RESTOCK_PLAN_SYSTEM_PROMPT},
+            {"role": "user", "content": orjson.dumps(user_payload, default=str).decode()}
         ], 
         model_name=model_name,
+        schema=RestockPlan,
     )
     
     
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Tests for the chat helpers in llm_modules/llm_utils.py
+Usage: python -m pytest test_llm_utils.py (or python test_llm_utils.py)
+"""
+import os
+import sys
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from llm_modules.llm_utils import extract_assigned_members
+
+
+def test_assigned_members_whole_words_in_member_order():
+    history = [{"role": "user", "content": "ann lee and BOB will cook; Annie brings drinks"}]
+    assert extract_assigned_members(history, ["Bob", "Ann Lee", "Ann", "Cara"]) == ["Bob", "Ann Lee"]
+
+
+def test_assigned_members_case_fold_only_match():
+    # "ſ" (long s) matches "S" under IGNORECASE, but "ſam".lower() is not "sam"
+    history = [{"role": "user", "content": "ask ſam to buy milk"}]
+    assert extract_assigned_members(history, ["Sam"]) == ["Sam"]
+
+
+if __name__ == "__main__":
+    test_assigned_members_whole_words_in_member_order()
+    test_assigned_members_case_fold_only_match()
+    print("✅ llm_utils tests passed")
@@ -1,65 +1,188 @@
 import os
+import time
+import hashlib
+import random
 import sqlite3
-import json
 import asyncio
+import numpy as np
+from openai import RateLimitError
 from sqlalchemy import select
 from tqdm.asyncio import tqdm  # Recommended for progress visualization
 
 # Import your existing modules
 from db import SessionLocal, GroceryItem
-from llm import get_embedding
+from llm import get_embeddings_batch, close_http_client
+from llm_modules.llm_utils import count_tokens
+from vector.vector_cache import read_embeddings_sqlite, NPY_MATRIX_FILE, NPY_IDS_FILE
 
 # --- Configuration ---
 # Save the sqlite file in the same directory as this script
 EMBED_DB_PATH = os.path.join(os.path.dirname(__file__), "embeddings.sqlite")
+# Packed copies for serving (memory-mapped by vector_cache), written next to the sqlite file
+EMBED_NPY_PATH = os.path.join(os.path.dirname(__file__), NPY_MATRIX_FILE)
+EMBED_IDS_NPY_PATH = os.path.join(os.path.dirname(__file__), NPY_IDS_FILE)
 
 # Batch size for SQLite inserts (improves disk I/O performance)
-BATCH_SIZE = 50 
+BATCH_SIZE = 1000
 
-# Limit concurrent API calls to OpenAI to avoid Rate Limit errors (429)
+# Rows per SQLite transaction: one fsync per commit, while an interrupted run still keeps its progress
+COMMIT_EVERY = 10000
+
+# Items embedded per OpenAI request (the API accepts up to 2048 inputs)
+EMBED_BATCH_SIZE = 128
+
+# Number of embedding workers = max concurrent API calls to OpenAI; the request rate is paced separately below
 CONCURRENCY_LIMIT = 10 
 
+# Rows fetched per round-trip while streaming grocery items from MySQL
+STREAM_CHUNK_ROWS = 1000
+
+# OpenAI embedding limits for the account tier: requests and tokens per minute
+EMBED_RPM = int(os.getenv("EMBED_RPM", "3000"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))
+
+# Retries of a batch rejected with 429 (Retry-After is honored, else exponential backoff)
+EMBED_MAX_RETRIES = 5
+
 # SQL to create the local embeddings table
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS grocery_item_embeddings (
     grocery_item_id INTEGER PRIMARY KEY,
-    embedding TEXT NOT NULL
+    embedding BLOB NOT NULL -- float32, L2-normalized
 );
 """
 
-async def process_item(semaphore, item):
-    """
-    Worker function to process a single grocery item.
-    1. Acquires a semaphore slot.
-    2. Calls OpenAI API to get the embedding.
-    3. Returns the result tuple for insertion.
-    """
-    async with semaphore:
+# OR IGNORE: re-inserting an id (e.g. after a partial run) is a no-op instead of an error
+INSERT_SQL = "INSERT OR IGNORE INTO grocery_item_embeddings (grocery_item_id, embedding) VALUES (?, ?)"
+
+# Items whose embedding text repeats an earlier item's reuse its vector: (item id, source item id)
+COPY_EMBEDDING_SQL = """
+INSERT OR IGNORE INTO grocery_item_embeddings (grocery_item_id, embedding)
+SELECT ?, embedding FROM grocery_item_embeddings WHERE grocery_item_id = ?
+"""
+
+def embedding_text(item) -> str:
+    # Combine title and sub_category for richer semantic search context
+    return f"{item.title} | {item.sub_category}"
+
+class TokenBucket:
+    """Async token bucket: refills `rate` units every `period` seconds, bursts up to `rate`."""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        # A single request larger than the bucket waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.fill_rate)
+
+class RateLimiter:
+    """Paces calls against both OpenAI limits (RPM and TPM), whichever binds."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    async def acquire(self, tokens: int):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+async def embed_texts(limiter, texts):
+    """get_embeddings_batch paced by the limiter, retrying 429s."""
+    est_tokens = sum(count_tokens(t) for t in texts)
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        await limiter.acquire(est_tokens)
         try:
-            # Combine title and sub_category for richer semantic search context
-            text_to_embed = f"{item.title} | {item.sub_category}"
-            
             # Call the LLM module (calls OpenAI text-embedding-3-large)
-            emb = await get_embedding(text_to_embed)
-            
+            return await get_embeddings_batch(texts)
+        except RateLimitError as e:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+            delay = float(retry_after) if retry_after else min(60, 2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, 1))
+
+async def process_batch(limiter, items):
+    """
+    Worker function to process a batch of grocery items (rows with id, title, sub_category).
+    1. Waits for the rate limiter.
+    2. Calls OpenAI API once to get the embeddings of the whole batch.
+    3. Returns the result tuples for insertion.
+    """
+    try:
+        texts = [embedding_text(item) for item in items]
+        
+        embs = await embed_texts(limiter, texts)
+        
+        results = []
+        for item, emb in zip(items, embs):
             # Basic validation
             if not emb or not isinstance(emb, list):
                 print(f"⚠️ Warning: No embedding returned for item ID {item.id} ({item.title})")
-                return None
-            
-            # Return tuple: (id, json_string_embedding, title_for_logging)
-            return (item.id, json.dumps(emb), item.title)
-            
-        except Exception as e:
-            print(f"❌ Error embedding item ID {item.id} ({item.title}): {e}")
-            return None
+                continue
+            # Unit length, so cosine similarity at search time is a plain dot product
+            vec = np.asarray(emb, dtype=np.float32)
+            norm = np.linalg.norm(vec)
+            if norm > 0:
+                vec /= norm
+            # Tuple: (id, raw float32 bytes) - 4 bytes/dim, no parsing on load
+            results.append((item.id, vec.tobytes()))
+        return results
+        
+    except Exception as e:
+        print(f"❌ Error embedding batch of {len(items)} items (IDs {items[0].id}..{items[-1].id}): {e}")
+        return []
+
+def write_rows(conn, results, commit: bool):
+    """Insert (id, embedding_blob) results; blocking, run via asyncio.to_thread."""
+    if results:
+        conn.executemany(INSERT_SQL, results)
+    if commit:
+        conn.commit()
+
+def copy_embeddings(conn, pairs):
+    """Insert (item id, source item id) pairs by copying the source's stored vector; blocking."""
+    conn.executemany(COPY_EMBEDDING_SQL, pairs)
+    conn.commit()
+
+def close_embeddings_db(conn):
+    """Fold the WAL back into the main file and close, so the shipped .sqlite is a single self-contained file."""
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+def pack_embeddings():
+    """
+    Write the sqlite embeddings as a float32 [N, D] .npy matrix plus an int64 .npy id array.
+    vector_cache memory-maps these instead of reading SQLite, so cold start no longer scales with N.
+    """
+    ids, matrix = read_embeddings_sqlite(EMBED_DB_PATH)
+    np.save(EMBED_NPY_PATH, matrix)
+    np.save(EMBED_IDS_NPY_PATH, ids)
+    print(f"📦 Packed {len(ids)} vectors into {EMBED_NPY_PATH} and {EMBED_IDS_NPY_PATH}")
 
 async def generate_and_store_embeddings():
     print(f"🚀 Starting embedding generation logic...")
     print(f"📂 Target Database: {EMBED_DB_PATH}")
 
     # 1. Initialize SQLite Database
-    conn = sqlite3.connect(EMBED_DB_PATH)
+    # Writes run in a worker thread (see write_rows), one at a time, so the connection may cross threads
+    conn = sqlite3.connect(EMBED_DB_PATH, check_same_thread=False)
+    # Bulk-load settings: WAL appends sequentially, NORMAL skips the per-commit fsync of the main file
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
     conn.execute(CREATE_TABLE_SQL)
     conn.commit()
 
@@ -69,68 +192,119 @@ async def generate_and_store_embeddings():
     )
     print(f"📋 Found {len(existing_ids)} existing vectors in SQLite. These will be skipped.")
 
-    # 3. Load Source Data from MySQL (Cloud SQL)
-    print("📥 Fetching grocery items from MySQL...")
-    async with SessionLocal() as session:
-        res = await session.execute(select(GroceryItem))
-        all_items = res.scalars().all()
-
-    # Filter out items that are already processed
-    items_to_process = [g for g in all_items if g.id not in existing_ids]
-    print(f"⚡ Total items to process: {len(items_to_process)}")
+    # 3. Prepare the pipeline: MySQL stream -> batches -> embedding workers -> results -> SQLite
+    limiter = RateLimiter(EMBED_RPM, EMBED_TPM)
+    batches: asyncio.Queue = asyncio.Queue(maxsize=CONCURRENCY_LIMIT * 2)
+    results: asyncio.Queue = asyncio.Queue()
+    # Duplicate texts are embedded once: 16-byte text digest -> first item id, later ones copied at the end
+    first_by_text = {}
+    duplicates = []
 
-    if not items_to_process:
-        print("✅ All items are already embedded. Nothing to do.")
-        conn.close()
-        return
+    async def produce():
+        """Stream the grocery items from MySQL (Cloud SQL) and queue the missing ones batch by batch."""
+        queued = 0
+        try:
+            async with SessionLocal() as session:
+                # Only the columns the embedding text needs, fetched in chunks instead of all at once
+                stream = await session.stream(
+                    select(GroceryItem.id, GroceryItem.title, GroceryItem.sub_category)
+                    .execution_options(yield_per=STREAM_CHUNK_ROWS)
+                )
+                batch = []
+                async for row in stream:
+                    if row.id in existing_ids:
+                        continue
+                    digest = hashlib.blake2b(embedding_text(row).encode("utf-8"), digest_size=16).digest()
+                    source_id = first_by_text.setdefault(digest, row.id)
+                    if source_id != row.id:
+                        duplicates.append((row.id, source_id))
+                        continue
+                    batch.append(row)
+                    if len(batch) == EMBED_BATCH_SIZE:
+                        await batches.put(batch)
+                        queued += len(batch)
+                        batch = []
+                if batch:
+                    await batches.put(batch)
+                    queued += len(batch)
+        finally:
+            # One stop marker per worker
+            for _ in range(CONCURRENCY_LIMIT):
+                await batches.put(None)
+        return queued
 
-    # 4. Prepare Concurrency Tools
-    semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
-    tasks = []
+    async def work():
+        while (batch := await batches.get()) is not None:
+            await results.put(await process_batch(limiter, batch))
+        await results.put(None)
 
-    # Create async tasks for all items
-    for item in items_to_process:
-        task = process_item(semaphore, item)
-        tasks.append(task)
+    # 4. Start streaming and embedding; API calls begin as soon as the first batch is read
+    print("📥 Streaming grocery items from MySQL...")
+    producer = asyncio.create_task(produce())
+    workers = [asyncio.create_task(work()) for _ in range(CONCURRENCY_LIMIT)]
 
-    # 5. Execute Tasks and Batch Write to SQLite
+    # 5. Batch Write to SQLite as results come in
     pending_inserts = []
-    
-    # process tasks as they complete
-    for f in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Generating Embeddings"):
-        result = await f
+    uncommitted = 0
+    running = len(workers)
+    progress = tqdm(desc="Generating Embeddings", unit="item")
+
+    while running:
+        batch_results = await results.get()
+        if batch_results is None:
+            running -= 1
+            continue
+        progress.update(len(batch_results))
         
-        if result:
-            pending_inserts.append(result)
+        pending_inserts.extend(batch_results)
 
         # Write to DB when batch size is reached
         if len(pending_inserts) >= BATCH_SIZE:
-            # Prepare data for executemany: [(id, embedding_json), ...]
-            data_to_insert = [(r[0], r[1]) for r in pending_inserts]
-            
-            conn.executemany(
-                "INSERT INTO grocery_item_embeddings (grocery_item_id, embedding) VALUES (?, ?)",
-                data_to_insert
-            )
-            conn.commit()
+            uncommitted += len(pending_inserts)
+            commit = uncommitted >= COMMIT_EVERY
+            # Off the event loop: the workers' API calls keep going while SQLite writes and fsyncs
+            await asyncio.to_thread(write_rows, conn, pending_inserts, commit)
             pending_inserts = [] # Clear the buffer
+            if commit:
+                uncommitted = 0
 
-    # 6. Insert any remaining items in the buffer
-    if pending_inserts:
-        data_to_insert = [(r[0], r[1]) for r in pending_inserts]
-        conn.executemany(
-            "INSERT INTO grocery_item_embeddings (grocery_item_id, embedding) VALUES (?, ?)",
-            data_to_insert
-        )
-        conn.commit()
+    progress.close()
+
+    # 6. Insert any remaining items in the buffer, commit the open transaction
+    await asyncio.to_thread(write_rows, conn, pending_inserts, True)
+
+    # Duplicates whose source failed to embed stay missing and are picked up by the next run
+    if duplicates:
+        await asyncio.to_thread(copy_embeddings, conn, duplicates)
+        print(f"♻️ Reused embeddings for {len(duplicates)} items with duplicate text")
+
+    try:
+        queued = await producer
+    except Exception:
+        # Keep what was embedded so far; a rerun resumes from there
+        close_embeddings_db(conn)
+        raise
+    print(f"⚡ Total items processed: {queued}")
+    if not queued and not duplicates:
+        print("✅ All items are already embedded. Nothing to do.")
 
     # 7. Final Cleanup
-    conn.close()
+    close_embeddings_db(conn)
+    pack_embeddings()
     print("🎉 Embedding generation complete!")
     print("-" * 50)
     print(f"👉 Next Step: Upload the generated file to GCS so Cloud Run can access it:")
     print(f"   gsutil cp {EMBED_DB_PATH} gs://groceryshopperai-embeddings/embeddings.sqlite")
+    print(f"   gsutil cp {EMBED_NPY_PATH} {EMBED_IDS_NPY_PATH} gs://groceryshopperai-embeddings/")
+    print(f"   (the packed .npy pair is preferred at serve time; the .sqlite is the fallback)")
     print("-" * 50)
 
+async def main():
+    try:
+        await generate_and_store_embeddings()
+    finally:
+        # Shared pooled client (llm.get_openai_client) used by every batch
+        await close_http_client()
+
 if __name__ == "__main__":
-    asyncio.run(generate_and_store_embeddings())
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
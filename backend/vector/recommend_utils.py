@@ -1,28 +1,40 @@
+import os
+import asyncio
 from sqlalchemy import select
 
 from db import GroceryItem
 from vector.vector_search import search_similar_items
 
-async def get_relevant_grocery_items(session, product_name: str, limit: int = 10):
+# Max embedding searches in flight per bulk lookup (each one is an embeddings API call)
+SEARCH_CONCURRENCY = int(os.getenv("GROCERY_SEARCH_CONCURRENCY", "10"))
+
+async def get_relevant_grocery_items_bulk(session, product_names, limit: int = 10):
     """
-    embedding-based grocery item matcher
-    Returns SQLAlchemy GroceryItem objects
+    Embedding-based grocery item matcher for a batch of product names.
+    Runs the embedding searches concurrently (at most SEARCH_CONCURRENCY at a time) and loads every matched item in one query.
+    Returns one list of GroceryItem objects per product name, in input order.
     """
+    if not product_names:
+        return []
 
-    scored = await search_similar_items(product_name, top_k=limit)
+    sem = asyncio.Semaphore(SEARCH_CONCURRENCY)
 
-    if not scored:
-        return []
+    async def search(name):
+        async with sem:
+            return await search_similar_items(name, top_k=limit)
 
-    ids = [gid for gid, _ in scored]
+    scored_lists = await asyncio.gather(*(search(name) for name in product_names))
+
+    all_ids = {gid for scored in scored_lists for gid, _ in scored}
+    if not all_ids:
+        return [[] for _ in product_names]
 
     res = await session.execute(
-        select(GroceryItem).where(GroceryItem.id.in_(ids))
+        select(GroceryItem).where(GroceryItem.id.in_(all_ids))
     )
-    items = res.scalars().all()
-
-    # Sort by embedding
-    id_to_item = {item.id: item for item in items}
-    sorted_items = [id_to_item[i] for i in ids if i in id_to_item]
+    id_to_item = {item.id: item for item in res.scalars().all()}
 
-    return sorted_items
\ No newline at end of file
+    return [
+        [id_to_item[gid] for gid, _ in scored if gid in id_to_item]
+        for scored in scored_lists
+    ]
@@ -1,7 +1,11 @@
 import os
-import json
+import logging
 import sqlite3
+import threading
 import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
 
 # --- PATH CONFIGURATION ---
 # Cloud Run uses /tmp because it's the only writable directory.
@@ -9,48 +13,162 @@ import numpy as np
 CLOUD_PATH = "/tmp/embeddings.sqlite"
 LOCAL_PATH = "./embeddings.sqlite"
 
-# Logic: Use /tmp if it exists (Cloud Run), otherwise fallback to local file.
-if os.path.exists(CLOUD_PATH):
-    EMBED_DB_PATH = CLOUD_PATH
-else:
-    EMBED_DB_PATH = LOCAL_PATH
+# Packed form (see embedding_loader.pack_embeddings): float32 [N, D] matrix + int64 ids,
+# memory-mapped so startup doesn't deserialize anything and pages load on first touch
+NPY_MATRIX_FILE = "embeddings.npy"
+NPY_IDS_FILE = "embedding_ids.npy"
+CLOUD_NPY_DIR = "/tmp"
+LOCAL_NPY_DIR = "."
+# Optional read-only directory with the packed pair, e.g. a Cloud Run Cloud Storage volume mount
+# of the embeddings bucket: files are paged in from GCS on demand, nothing is downloaded up front
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "").strip()
+
 # --------------------------
 
+
+def resolve_embed_db_path():
+    """Use /tmp if it exists (Cloud Run), otherwise fallback to local file.
+    Resolved at load time, since app.py downloads the /tmp copy in the background after import."""
+    if os.path.exists(CLOUD_PATH):
+        return CLOUD_PATH
+    return LOCAL_PATH
+
+def resolve_npy_paths():
+    """(matrix path, ids path) of the first packed pair that exists (EMBEDDINGS_DIR, /tmp, ./); None if there is none."""
+    for directory in (EMBEDDINGS_DIR, CLOUD_NPY_DIR, LOCAL_NPY_DIR):
+        if not directory:
+            continue
+        matrix_path = os.path.join(directory, NPY_MATRIX_FILE)
+        ids_path = os.path.join(directory, NPY_IDS_FILE)
+        if os.path.exists(matrix_path) and os.path.exists(ids_path):
+            return matrix_path, ids_path
+    return None
+
+# Bytes of the embeddings DB SQLite may memory-map while loading
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# "int8": keep unit-normalized vectors as int8 codes + one float32 scale per row (1/4 of the RAM,
+# ~same ranking). Empty/other: keep the float32 matrix as loaded.
+EMBEDDINGS_QUANTIZATION = os.getenv("EMBEDDINGS_QUANTIZATION", "").strip().lower()
+
+# Rows converted at a time while quantizing, so no full-size float32 temporary is needed
+QUANTIZE_CHUNK_ROWS = 4096
+
+# (ids int64[N], matrix [N, D], scales float32[N] or None): one contiguous block of unit (or zero) rows,
+# so cosine similarity is a single mat @ q_unit. With scales, matrix holds int8 codes and row i ~= matrix[i] * scales[i].
 _cached_vectors = None
+# Serializes the first load: concurrent first searches wait for one reader instead of each reading the file
+_load_lock = threading.Lock()
 
+def _empty_vectors():
+    return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), None
 
-def load_embeddings_into_memory():
-    global _cached_vectors
-    if _cached_vectors is not None:
-        return _cached_vectors
+def quantize_int8(matrix: np.ndarray):
+    """Symmetric per-row int8 quantization of the (re-)normalized rows: (codes int8[N, D], scales float32[N])."""
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), QUANTIZE_CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + QUANTIZE_CHUNK_ROWS], dtype=np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        unit = block / np.where(norms == 0, 1, norms)
+        # Zero vectors keep all-zero codes (and score 0), with a harmless scale of 1
+        block_scales = np.abs(unit).max(axis=1) / 127
+        block_scales[block_scales == 0] = 1
+        codes[start:start + len(block)] = np.round(unit / block_scales[:, None])
+        scales[start:start + len(block)] = block_scales
+    return codes, scales
 
-    if not os.path.exists(EMBED_DB_PATH):
-        print(f"[vector_cache] ERROR: Database not found at {EMBED_DB_PATH}")
-        print(f"[vector_cache] Make sure app.py downloaded it to /tmp or it exists locally.")
-        _cached_vectors = []
-        return _cached_vectors
+def _warm_up(matrix):
+    """One tiny matrix-vector product, so BLAS start-up (thread pool, kernel dispatch) happens during the load, not in the first search."""
+    if len(matrix):
+        np.asarray(matrix[:1], dtype=np.float32) @ np.zeros(matrix.shape[1], dtype=np.float32)
+
+def _prepare_vectors(ids, matrix):
+    if EMBEDDINGS_QUANTIZATION == "int8" and len(ids):
+        codes, scales = quantize_int8(matrix)
+        _warm_up(codes)
+        return ids, codes, scales
+    _warm_up(matrix)
+    return ids, matrix, None
 
-    print(f"[vector_cache] Loading embeddings from {EMBED_DB_PATH} ...")
+def _decode_embedding(emb):
+    if isinstance(emb, bytes):
+        # Raw float32 BLOB: used as-is, no parsing
+        return np.frombuffer(emb, dtype=np.float32)
+    # JSON text written by older embedding_loader runs: the parsed list is copied straight into its matrix row
+    return orjson.loads(emb)
 
+
+def read_embeddings_sqlite(db_path):
+    """Read every row of the embeddings DB into (ids int64[N], matrix float32[N, D])."""
+    # Read-only and memory-mapped: the bulk read comes straight from the OS page cache
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
     try:
-        conn = sqlite3.connect(EMBED_DB_PATH)
-        cursor = conn.cursor()
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA query_only=1")
         # Ensure the table name matches your actual DB schema
-        cursor.execute("SELECT grocery_item_id, embedding FROM grocery_item_embeddings")
-        rows = cursor.fetchall()
+        rows = conn.execute("SELECT grocery_item_id, embedding FROM grocery_item_embeddings").fetchall()
+    finally:
         conn.close()
 
-        vectors = []
-        for gid, emb in rows:
-            # Parse JSON string back to numpy array
-            arr = np.array(json.loads(emb), dtype=np.float32)
-            vectors.append((gid, arr))
+    ids = np.empty(len(rows), dtype=np.int64)
+    matrix = None
+    for i, (gid, emb) in enumerate(rows):
+        vec = _decode_embedding(emb)
+        if matrix is None:
+            # Dimension comes from the first row; rows are copied straight into the preallocated block
+            matrix = np.empty((len(rows), len(vec)), dtype=np.float32)
+        ids[i] = gid
+        matrix[i] = vec
+
+    if matrix is None:
+        return _empty_vectors()[:2]
+    # Rows from older files may not be unit length; normalizing here keeps the packed .npy normalized too
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return ids, matrix
+
+
+def load_embeddings_into_memory():
+    if _cached_vectors is not None:
+        return _cached_vectors
+    with _load_lock:
+        # Another thread may have finished the load while this one waited
+        if _cached_vectors is not None:
+            return _cached_vectors
+        return _load_embeddings()
+
+
+def _load_embeddings():
+    global _cached_vectors
+    npy_paths = resolve_npy_paths()
+    if npy_paths is not None:
+        matrix_path, ids_path = npy_paths
+        try:
+            matrix = np.load(matrix_path, mmap_mode="r")
+            ids = np.load(ids_path, mmap_mode="r")
+            if matrix.ndim != 2 or len(ids) != len(matrix):
+                raise ValueError(f"shape mismatch: {matrix.shape} vs {ids.shape} ids")
+            _cached_vectors = _prepare_vectors(ids, matrix)
+            logger.info("Memory-mapped %d vectors from %s", len(ids), matrix_path)
+            return _cached_vectors
+        except Exception as e:
+            logger.warning("Packed embeddings unusable (%s), falling back to SQLite", e)
 
-        _cached_vectors = vectors
-        print(f"[vector_cache] Loaded {len(vectors)} vectors into memory")
+    EMBED_DB_PATH = resolve_embed_db_path()
+    if not os.path.exists(EMBED_DB_PATH):
+        logger.error("Embeddings database not found at %s; make sure app.py downloaded it to /tmp or it exists locally", EMBED_DB_PATH)
+        # Not cached, so the next search picks the file up once the download finishes
+        return _empty_vectors()
+
+    logger.info("Loading embeddings from %s ...", EMBED_DB_PATH)
+
+    try:
+        _cached_vectors = _prepare_vectors(*read_embeddings_sqlite(EMBED_DB_PATH))
+        logger.info("Loaded %d vectors into memory", len(_cached_vectors[0]))
     except Exception as e:
-        print(f"[vector_cache] Database error: {e}")
-        _cached_vectors = []
+        logger.error("Embeddings database error: %s", e)
+        _cached_vectors = _empty_vectors()
 
     return _cached_vectors
 
@@ -1,28 +1,54 @@
+import asyncio
+
 import numpy as np
 
 from llm import get_embedding
 from vector.vector_cache import get_cached_embeddings
 
+# Rows scored per step for int8 embeddings (converted to float32 a block at a time)
+SCORE_CHUNK_ROWS = 4096
 
 async def embed_query(text: str):
     """LLM embedding for the search query"""
     return np.array(await get_embedding(text), dtype=np.float32)
 
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    if np.linalg.norm(a) == 0 or np.linalg.norm(b) == 0:
-        return 0.0
-    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+def int8_cosine_scores(codes: np.ndarray, scales: np.ndarray, q_emb: np.ndarray) -> np.ndarray:
+    """Cosine similarity against int8-quantized unit vectors (see vector_cache.quantize_int8)."""
+    q_norm = np.linalg.norm(q_emb)
+    if q_norm == 0:
+        return np.zeros(len(codes), dtype=np.float32)
+    q_unit = (q_emb / q_norm).astype(np.float32)
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_CHUNK_ROWS):
+        block = codes[start:start + SCORE_CHUNK_ROWS]
+        scores[start:start + len(block)] = block.astype(np.float32) @ q_unit
+    return scores * scales
 
 async def search_similar_items(query: str, top_k: int = 10):
     """Return top-k matched grocery items by cosine similarity."""
     q_emb = await embed_query(query)
-    all_vectors = get_cached_embeddings()
-
-    scored = []
-    for gid, vector in all_vectors:
-        score = cosine_similarity(q_emb, vector)
-        scored.append((gid, score))
-
-    scored.sort(key=lambda x: x[1], reverse=True)
-
-    return scored[:top_k]
\ No newline at end of file
+    # The first call loads the embeddings, and scoring is a large product (BLAS releases the GIL): both run off the event loop
+    return await asyncio.to_thread(rank_items, q_emb, top_k)
+
+def rank_items(q_emb: np.ndarray, top_k: int):
+    """Top-k (item id, cosine similarity) pairs for a query embedding."""
+    ids, matrix, scales = get_cached_embeddings()
+    if len(ids) == 0 or top_k <= 0:
+        return []
+
+    if scales is not None:
+        scores = int8_cosine_scores(matrix, scales, q_emb)
+    else:
+        # Stored rows are unit length: cosine similarity is one matrix-vector product (zero vectors score 0)
+        q_norm = np.linalg.norm(q_emb)
+        if q_norm == 0:
+            scores = np.zeros(len(ids), dtype=np.float32)
+        else:
+            scores = matrix @ (q_emb / q_norm)
+
+    # Partial selection of the top k, then sort just those
+    k = min(top_k, len(ids))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+
+    return [(int(ids[i]), float(scores[i])) for i in top]
@@ -1,39 +1,228 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+import msgpack
+import orjson
+from fastapi import WebSocket
 
+logger = logging.getLogger("grocery.ws")
 
-from typing import Dict, Set
-from fastapi import WebSocket
+ROOM_CHANNEL_PREFIX = "room:"
+
+# Wire formats a client can pick with ?format=...; "msgpack" sends binary frames
+WS_FORMATS = ("json", "msgpack")
+
+# Outbound frames buffered per socket. A client this far behind on committed frames is disconnected,
+# so it reconnects and reloads history instead of silently missing messages
+SEND_QUEUE_MAXSIZE = 32
+# Progressive frames whose content a later committed frame repeats (the final message / ai_event):
+# skipped once a socket's queue is this full, which leaves the rest of the queue for committed frames
+DROPPABLE_FRAME_TYPES = frozenset({"message_chunk", "ai_event_item"})
+DROPPABLE_HIGH_WATER = SEND_QUEUE_MAXSIZE // 2
+
+# Opt-in coalescing (?batch=1): frames queued within this window go out as one array frame
+COALESCE_WINDOW_SECONDS = 0.01
+
+def _encode_batch(frames: list, fmt: str):
+    """Join already-encoded frames into one array frame without re-encoding each message"""
+    if fmt == "msgpack":
+        return msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames)
+    return "[" + ",".join(frames) + "]"
+
+def _msgpack_default(obj):
+    # Same ISO 8601 form orjson gives the JSON path, so a field reads the same in either format
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return str(obj)
+
+def _encode(message: dict, fmt: str):
+    if fmt == "msgpack":
+        return msgpack.packb(message, use_bin_type=True, default=_msgpack_default)
+    # orjson (C) is several times faster than stdlib json; text frames need a str
+    return orjson.dumps(message, default=str).decode()
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[int, Set[WebSocket]] = {}  # room_id -> set of WebSockets
+        self.connection_formats: Dict[WebSocket, str] = {}  # WebSocket -> wire format
+        self.last_seen: Dict[WebSocket, float] = {}  # WebSocket -> monotonic time of last inbound frame
+        # Each socket has its own outbound queue drained by a relay task, so one slow client can't stall a broadcast
+        self.send_queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.relay_tasks: Dict[WebSocket, asyncio.Task] = {}
+        self.coalescing: Set[WebSocket] = set()  # sockets that receive array frames (?batch=1)
+        # Optional Redis pub/sub fan-out so every worker process reaches its own sockets
+        self._redis = None
+        self._pubsub = None
+        self._listener_task: Optional[asyncio.Task] = None
 
-    async def connect(self, websocket: WebSocket, room_id: int):
+    async def connect(self, websocket: WebSocket, room_id: int, fmt: str = "json", coalesce: bool = False):
         await websocket.accept()
+        self.connection_formats[websocket] = fmt
+        if coalesce:
+            self.coalescing.add(websocket)
+        self.last_seen[websocket] = time.monotonic()
+        self.send_queues[websocket] = asyncio.Queue(maxsize=SEND_QUEUE_MAXSIZE)
+        self.relay_tasks[websocket] = asyncio.create_task(self._relay(websocket, room_id))
         if room_id not in self.active_connections:
             self.active_connections[room_id] = set()
         self.active_connections[room_id].add(websocket)
-        total = sum(len(conns) for conns in self.active_connections.values())
-        print(f"[WS] connect room {room_id} -> {len(self.active_connections[room_id])} in room, {total} total") 
+        if logger.isEnabledFor(logging.DEBUG):
+            total = sum(len(conns) for conns in self.active_connections.values())
+            logger.debug("connect room %s -> %d in room, %d total", room_id, len(self.active_connections[room_id]), total)
 
     def disconnect(self, websocket: WebSocket, room_id: int):
         if room_id in self.active_connections and websocket in self.active_connections[room_id]:
             self.active_connections[room_id].remove(websocket)
+            self.connection_formats.pop(websocket, None)
+            self.last_seen.pop(websocket, None)
+            self.send_queues.pop(websocket, None)
+            self.coalescing.discard(websocket)
+            relay = self.relay_tasks.pop(websocket, None)
+            if relay is not None and relay is not asyncio.current_task():
+                relay.cancel()
             if not self.active_connections[room_id]:
                 del self.active_connections[room_id]
-            total = sum(len(conns) for conns in self.active_connections.values())
-            print(f"[WS] disconnect room {room_id} -> {total} total active")
+            if logger.isEnabledFor(logging.DEBUG):
+                total = sum(len(conns) for conns in self.active_connections.values())
+                logger.debug("disconnect room %s -> %d total active", room_id, total)
+
+    def touch(self, websocket: WebSocket):
+        self.last_seen[websocket] = time.monotonic()
+
+    async def send_personal(self, message: dict, websocket: WebSocket):
+        fmt = self.connection_formats.get(websocket, "json")
+        self._enqueue(websocket, _encode(message, fmt), message.get("type") in DROPPABLE_FRAME_TYPES)
+
+    def _enqueue(self, websocket: WebSocket, frame, droppable: bool = False):
+        queue = self.send_queues.get(websocket)
+        if queue is None:
+            return
+        if droppable and queue.qsize() >= DROPPABLE_HIGH_WATER:
+            # A lagging client skips streaming deltas; the committed frame that follows carries the full content
+            logger.debug("send queue backed up, skipped a streaming frame")
+            return
+        if queue.full():
+            # Never drop a committed frame: cut the client off so it reconnects and reloads history
+            logger.warning("send queue full, disconnecting lagging client")
+            self.send_queues.pop(websocket, None)
+            asyncio.create_task(self._drop_lagging(websocket))
+            return
+        queue.put_nowait(frame)
+
+    async def _drop_lagging(self, websocket: WebSocket):
+        for room_id, conns in list(self.active_connections.items()):
+            if websocket in conns:
+                self.disconnect(websocket, room_id)
+        try:
+            # 1013 "try again later": the client should reconnect and resync
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _relay(self, websocket: WebSocket, room_id: int):
+        """Drain one socket's send queue; on a failed send, close and drop the connection"""
+        queue = self.send_queues[websocket]
+        try:
+            while True:
+                frame = await queue.get()
+                if websocket in self.coalescing:
+                    # Let the burst accumulate briefly, then send everything queued as one frame
+                    await asyncio.sleep(COALESCE_WINDOW_SECONDS)
+                    frames = [frame]
+                    while not queue.empty():
+                        frames.append(queue.get_nowait())
+                    frame = _encode_batch(frames, self.connection_formats.get(websocket, "json"))
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+            self.disconnect(websocket, room_id)
+
+    async def sweep_stale(self, max_idle: float) -> int:
+        """Close and drop connections that have not sent anything (including pongs) for max_idle seconds"""
+        cutoff = time.monotonic() - max_idle
+        stale = [
+            (ws, room_id)
+            for room_id, conns in self.active_connections.items()
+            for ws in conns
+            if self.last_seen.get(ws, 0) < cutoff
+        ]
+        for ws, room_id in stale:
+            try:
+                await ws.close(code=1001)
+            except Exception:
+                pass
+            self.disconnect(ws, room_id)
+        return len(stale)
+
+    async def start_pubsub(self, redis_url: str):
+        """Subscribe to every room channel and relay published messages to local sockets"""
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(redis_url, decode_responses=True)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.psubscribe(f"{ROOM_CHANNEL_PREFIX}*")
+        self._listener_task = asyncio.create_task(self._listen())
+        logger.info("Redis pub/sub enabled")
+
+    async def stop_pubsub(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+        if self._pubsub:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._redis:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async for item in self._pubsub.listen():
+                    if item.get("type") != "pmessage":
+                        continue
+                    room_id = int(item["channel"][len(ROOM_CHANNEL_PREFIX):])
+                    await self.broadcast_local(orjson.loads(item["data"]), room_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Redis listener error")
+                await asyncio.sleep(1)
 
     async def broadcast(self, message: dict, room_id: int):
-        """Broadcast message to all connections in a specific room"""
+        """Broadcast message to all connections in a specific room (across workers when Redis is enabled)"""
+        if self._redis is not None:
+            try:
+                await self._redis.publish(f"{ROOM_CHANNEL_PREFIX}{room_id}", orjson.dumps(message, default=str))
+                return
+            except Exception:
+                # The message is already committed: reach this worker's sockets at least (others reload history)
+                logger.exception("Redis publish failed for room %s, broadcasting locally", room_id)
+        await self.broadcast_local(message, room_id)
+
+    async def broadcast_local(self, message: dict, room_id: int):
+        """Broadcast message to the connections held by this process"""
         if room_id not in self.active_connections:
             return
-        
+
+        # Encode at most once per wire format, then hand the frame to each socket's relay
+        encoded: Dict[str, object] = {}
+        droppable = message.get("type") in DROPPABLE_FRAME_TYPES
         for connection in list(self.active_connections[room_id]):
-            try:
-                await connection.send_json(message)
-            except Exception:
-                try:
-                    await connection.close()
-                except Exception:
-                    pass
-                self.disconnect(connection, room_id)
+            fmt = self.connection_formats.get(connection, "json")
+            if fmt not in encoded:
+                encoded[fmt] = _encode(message, fmt)
+            self._enqueue(connection, encoded[fmt], droppable)
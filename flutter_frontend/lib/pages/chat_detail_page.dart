@@ -82,7 +82,7 @@ class _ChatDetailPageState extends State<ChatDetailPage> {
 
       try {
         // Connect via ApiClient
-        apiClient.connectWebSocket(int.parse(widget.roomId));
+        apiClient.connectWebSocket(int.parse(widget.roomId), token);
 
         await _loadMessages();
 
@@ -1,5 +1,4 @@
 import 'package:flutter/material.dart';
-import 'dart:convert';
 import '../services/api_client.dart';
 import '../themes/colors.dart';
 
@@ -220,10 +219,10 @@ class _InventoryPageState extends State<InventoryPage> {
   }
 
   Widget _buildShoppingListCard(BuildContext context, dynamic list, bool isDark) {
-    // Parse items JSON
+    // Items arrive already decoded in the response
     List<dynamic> items = [];
     try {
-      items = jsonDecode(list['items_json']);
+      items = list['items'] as List<dynamic>;
     } catch (_) {}
 
     return Container(
@@ -140,8 +140,9 @@ class ApiClient {
     return res['rooms'] as List<dynamic>;
   }
 
-  Future<List<dynamic>> getRoomMessages(int roomId) async {
-    final res = await get('/rooms/$roomId/messages');
+  Future<List<dynamic>> getRoomMessages(int roomId, {int? beforeId}) async {
+    final query = beforeId != null ? '?before_id=$beforeId' : '';
+    final res = await get('/rooms/$roomId/messages$query');
     return res['messages'] as List<dynamic>;
   }
 
@@ -254,11 +255,11 @@ class ApiClient {
   Stream<AIEvent> get aiEventStream => _aiEventController.stream;
   Stream<Map<String, dynamic>> get messageStream => _messageController.stream;
 
-  void connectWebSocket(int roomId) {
+  void connectWebSocket(int roomId, String token) {
     disconnectWebSocket(); // Ensure no existing connection
 
-    final url = '$wsUrl?room_id=$roomId';
-    print('[ApiClient] Connecting to WebSocket: $url');
+    final url = '$wsUrl/$roomId?token=${Uri.encodeQueryComponent(token)}';
+    print('[ApiClient] Connecting to WebSocket: $wsUrl/$roomId');
     
     try {
       _channel = WebSocketChannel.connect(Uri.parse(url));
@@ -268,7 +269,10 @@ class ApiClient {
           print('[ApiClient] WS Message: $message');
           try {
             final data = jsonDecode(message);
-            if (data['type'] == 'ai_event') {
+            if (data['type'] == 'ping') {
+              // Server heartbeat; answer so the connection is not evicted
+              _channel?.sink.add(jsonEncode({'type': 'pong'}));
+            } else if (data['type'] == 'ai_event') {
               final event = AIEvent.fromJson(data);
               _aiEventController.add(event);
             } else if (data['type'] == 'message') {
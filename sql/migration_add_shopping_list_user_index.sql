@@ -0,0 +1,9 @@
+-- Migration: Add composite index for the active shopping lists query
+-- get_shopping_lists filters by user_id and is_archived and orders by created_at DESC;
+-- this index covers the filter and the sort, so MySQL reads rows in order without a filesort
+-- (inventory(user_id, product_name) is already indexed by uniq_user_product)
+
+CREATE INDEX idx_shopping_lists_user_archived_created ON shopping_lists(user_id, is_archived, created_at);
+
+-- Check the plan (should show the new index and no "Using filesort"):
+-- EXPLAIN SELECT * FROM shopping_lists WHERE user_id = 1 AND is_archived = 0 ORDER BY created_at DESC;
@@ -78,6 +78,18 @@ CREATE TABLE IF NOT EXISTS inventory (
   UNIQUE KEY uniq_user_product (user_id, product_name)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Per-user/restaurant inventory items';
 
+CREATE TABLE IF NOT EXISTS shopping_lists (
+  id INT AUTO_INCREMENT PRIMARY KEY,
+  user_id INT NOT NULL,
+  title VARCHAR(255) NOT NULL,
+  items_json TEXT NOT NULL,  -- items as a JSON string
+  is_archived BOOLEAN DEFAULT FALSE,
+  created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+  CONSTRAINT fk_shopping_list_user FOREIGN KEY (user_id) REFERENCES users(id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE INDEX idx_shopping_lists_user_archived_created ON shopping_lists(user_id, is_archived, created_at);
+
 -- Convert from load_groceries.py
 CREATE TABLE IF NOT EXISTS grocery_items (
     id INT AUTO_INCREMENT PRIMARY KEY,